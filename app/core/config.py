@@ -15,9 +15,15 @@ class Settings(BaseSettings):
     
     # 拼接绝对路径，防止找不到文件
     DB_PATH: str = os.path.join(BASE_DIR, "data", "zai.db")
+    DB_READER_POOL_SIZE: int = 4  # 只读连接池大小
+    DB_BUSY_TIMEOUT: int = 5000  # SQLite 忙等待超时（毫秒）
     
     # 账号数据目录 - 统一存储所有账号的浏览器数据
     ACCOUNTS_DATA_DIR: str = os.path.join(BASE_DIR, "accounts_data")
+    REFRESH_CONCURRENCY: int = 2  # 同时运行的刷新浏览器数量上限
+    TOKEN_REFRESH_LEAD: float = 900.0  # 在 Token 过期前多少秒刷新
+    TOKEN_REFRESH_JITTER: float = 300.0  # 额外提前的随机抖动上限（秒）
+    TOKEN_REFRESH_RETRY_DELAY: float = 300.0  # 刷新失败后的重试间隔（秒）
     
     # Hugging Face Space 特定配置
     HF_SPACE: bool = os.environ.get("HF_SPACE", "true").lower() == "true"
@@ -27,5 +33,88 @@ class Settings(BaseSettings):
     # Zai 配置
     ZAI_BASE_URL: str = "https://zai.is"
     DEFAULT_MODEL: str = "gpt-5-2025-08-07"
+    
+    # 上游连接池配置（每个账号独立一个连接池，Token 之间不共享连接）
+    UPSTREAM_TIMEOUT: float = 120.0
+    UPSTREAM_CONNECT_TIMEOUT: float = 10.0
+    UPSTREAM_MAX_CONNECTIONS: int = 20
+    UPSTREAM_MAX_KEEPALIVE: int = 10
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 60.0
+    UPSTREAM_HTTP2: bool = True
+    
+    # Token 验证结果缓存与并发
+    VERIFY_CACHE_TTL: float = 300.0  # 有效结果缓存时间（秒）
+    VERIFY_NEGATIVE_CACHE_TTL: float = 60.0  # 无效结果缓存时间（秒）
+    VERIFY_CONCURRENCY: int = 4  # 同时进行的验证请求上限
+    HEALTH_CHECK_INTERVAL: float = 600.0  # 后台账号健康探测间隔（秒）
+    
+    # 账号池负载均衡策略: round_robin / least_inflight / weighted
+    ACCOUNT_POOL_STRATEGY: str = "round_robin"
+    ACCOUNT_SUCCESS_DECAY: float = 0.2  # 成功率滑动平均的衰减系数
+    ACCOUNT_MAX_CONCURRENCY: int = 4  # 单个账号同时处理的请求上限，0 表示不限
+    RATE_LIMIT_COOLDOWN: float = 60.0  # 被限流（429）且上游未给出 Retry-After 时的冷却时间（秒）
+    RATE_LIMIT_MAX_COOLDOWN: float = 900.0  # 冷却时间上限（秒）
+    
+    # 准入控制：并发上限 = 可用账号数 × 每账号并发上限，超出部分排队
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_SLOTS_PER_ACCOUNT: int = 4  # ACCOUNT_MAX_CONCURRENCY 为 0（不限）时每个账号计入的名额
+    ADMISSION_QUEUE_FACTOR: float = 2.0  # 等待队列长度上限 = 容量 × 该系数
+    ADMISSION_MAX_WAIT: float = 10.0  # interactive 通道最长排队时间（秒）
+    ADMISSION_BATCH_MAX_WAIT: float = 60.0  # batch 通道最长排队时间（秒）
+    ADMISSION_BATCH_SHARE: int = 4  # 两条通道都有排队时，每 N 次放行至少有一次给 batch
+    ADMISSION_BATCH_KEYS: str = ""  # 归入 batch 通道的 API Key（逗号分隔）
+    ADMISSION_SERVICE_DECAY: float = 0.2  # 平均服务时间滑动平均的衰减系数
+    
+    # 账号熔断器
+    BREAKER_FAILURE_THRESHOLD: int = 3  # 连续 5xx / 网络错误达到该次数后熔断
+    BREAKER_OPEN_SECONDS: float = 30.0  # 熔断时长（秒），半开探测失败后翻倍
+    BREAKER_MAX_OPEN_SECONDS: float = 600.0  # 熔断时长上限（秒）
+    BREAKER_AUTH_OPEN_SECONDS: float = 300.0  # 认证失败（401）的熔断时长（秒），刷新 Token 后立即恢复
+    
+    # 故障转移：在该时限内（秒）依次尝试账号，直到上游流真正开始输出
+    FAILOVER_DEADLINE: float = 30.0
+    
+    # 客户端断开检测间隔（秒）：断开后立即关闭上游连接并释放账号
+    DISCONNECT_CHECK_INTERVAL: float = 1.0
+    
+    # 会话复用：多轮对话续接到同一个 Zai 对话上
+    CONVERSATION_REUSE: bool = True
+    CONVERSATION_CACHE_SIZE: int = 5000  # 内存中最多保留的会话索引数
+    CONVERSATION_TTL: float = 86400.0  # 会话索引有效期（秒）
+    CONVERSATION_PERSIST: bool = True  # 是否持久化到 SQLite
+    
+    # 响应缓存（默认关闭）：相同请求直接回放已缓存的回复
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_DETERMINISTIC_ONLY: bool = True  # 只缓存 temperature 为 0 的请求
+    RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024  # 内存层容量上限（按回复字节数计）
+    RESPONSE_CACHE_TTL: float = 3600.0  # 缓存有效期（秒）
+    RESPONSE_CACHE_PERSIST: bool = False  # 是否启用 SQLite 持久层
+    RESPONSE_CACHE_REPLAY_INTERVAL_MS: float = 0.0  # 流式回放时片段之间的间隔（毫秒），0 表示立即发送
+    
+    # 单飞（默认关闭）：相同请求并发到达时共用一次上游请求，只适合确定性参数
+    SINGLE_FLIGHT_MODELS: str = ""  # 开启的模型（逗号分隔），"*" 表示全部模型
+    SINGLE_FLIGHT_WAIT_TIMEOUT: float = 120.0  # 订阅者等待首个内容的最长时间（秒），超时后自行请求上游
+    
+    # 图片代理：共用连接池流式转发，按内容哈希缓存到 media/proxy/（不受 30 分钟图片清理影响）
+    IMAGE_PROXY_TIMEOUT: float = 30.0
+    IMAGE_PROXY_MAX_CONNECTIONS: int = 20
+    IMAGE_CACHE_MAX_BYTES: int = 256 * 1024 * 1024  # 磁盘缓存容量上限，超出后按最近最少使用淘汰
+    
+    # 预创建对话池：按请求速率为每个 (账号, 模型) 预先创建空对话
+    CHAT_POOL_ENABLED: bool = True
+    CHAT_POOL_MAX: int = 4  # 每个 (账号, 模型) 的库存上限
+    CHAT_POOL_HORIZON: float = 30.0  # 按未来多少秒的预计请求量备货
+    CHAT_POOL_RATE_DECAY: float = 0.3  # 请求速率滑动平均的衰减系数
+    CHAT_POOL_INTERVAL: float = 5.0  # 补货检查间隔（秒）
+    CHAT_POOL_MAX_AGE: float = 1800.0  # 预创建对话的最长保留时间（秒）
+    
+    # 流式增量合并（默认关闭）：窗口内到达的小片段合并为一个 SSE 块
+    STREAM_COALESCE_WINDOW_MS: float = 0.0  # 合并窗口（毫秒），0 表示不合并，建议 10-30
+    STREAM_COALESCE_MAX_BYTES: int = 2048  # 缓冲内容达到该字节数立即发送
+    
+    # 请求日志异步批量写入
+    LOG_QUEUE_SIZE: int = 10000  # 内存队列上限，超出的日志被丢弃并计数
+    LOG_BATCH_SIZE: int = 200  # 达到该条数立即落盘
+    LOG_FLUSH_INTERVAL: float = 1.0  # 最长落盘间隔（秒）
 
 settings = Settings()
\ No newline at end of file
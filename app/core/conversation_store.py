@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话索引 - 把 OpenAI 的消息历史映射到 Zai 上已存在的对话
+
+架构原则：
+- 以消息前缀的滚动哈希为键：h(i) = sha256(h(i-1) + role + \0 + content)
+- 值为 Zai 的 chat_id、最后一条助手消息的节点 id 及所属账号
+- 内存 LRU + TTL 为一级缓存，SQLite 为可选的持久层
+- 后续轮次命中时，在同一账号的同一对话上追加，只发送新增的消息
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from loguru import logger
+from app.core.config import settings
+from app.core.db_manager import db_manager
+
+
+class ConversationEntry:
+    """一个可续接的 Zai 对话位置"""
+
+    __slots__ = ("chat_id", "parent_id", "account_id", "model", "updated_at")
+
+    def __init__(self, chat_id: str, parent_id: str, account_id: int, model: str, updated_at: float):
+        self.chat_id = chat_id
+        self.parent_id = parent_id
+        self.account_id = account_id
+        self.model = model
+        self.updated_at = updated_at
+
+
+class ConversationMatch:
+    """一次命中：续接的位置，以及需要发送的增量消息起点"""
+
+    __slots__ = ("entry", "delta_start")
+
+    def __init__(self, entry: ConversationEntry, delta_start: int):
+        self.entry = entry
+        self.delta_start = delta_start
+
+    @property
+    def chat_id(self):
+        return self.entry.chat_id
+
+    @property
+    def parent_id(self):
+        return self.entry.parent_id
+
+
+def _content_text(content) -> str:
+    """消息内容规范化为字符串（多模态内容按 JSON 序列化）"""
+    if isinstance(content, str):
+        return content
+    return json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+class ConversationStore:
+    """会话索引 - 单例使用"""
+
+    def __init__(self):
+        self.max_entries = settings.CONVERSATION_CACHE_SIZE
+        self.ttl = settings.CONVERSATION_TTL
+        self.persist = settings.CONVERSATION_PERSIST
+        self._entries: "OrderedDict[str, ConversationEntry]" = OrderedDict()
+
+    # ==================== 哈希 ====================
+
+    @staticmethod
+    def prefix_hashes(model: str, messages: List[dict]) -> List[str]:
+        """返回每个消息前缀的哈希，hashes[i] 对应 messages[:i+1]"""
+        state = hashlib.sha256(model.encode("utf-8")).digest()
+        hashes = []
+        for msg in messages:
+            h = hashlib.sha256(state)
+            h.update(str(msg.get("role", "")).encode("utf-8") + b"\0")
+            h.update(_content_text(msg.get("content", "")).encode("utf-8"))
+            state = h.digest()
+            hashes.append(state.hex())
+        return hashes
+
+    @staticmethod
+    def assistant_hasher(prefix_hash: str):
+        """为即将生成的助手回复创建增量哈希器，流式输出时逐片 update 即可"""
+        h = hashlib.sha256(bytes.fromhex(prefix_hash))
+        h.update(b"assistant\0")
+        return h
+
+    # ==================== 查询与记录 ====================
+
+    async def lookup(self, messages: List[dict], hashes: List[str]) -> Optional[ConversationMatch]:
+        """
+        查找可续接的最长前缀：前缀必须以助手消息结尾，且其后至少还有一条新消息
+        hashes 为 prefix_hashes() 的结果（已包含模型，不同模型不会互相命中）
+        """
+        if not settings.CONVERSATION_REUSE or len(messages) < 3:
+            return None
+        for end in range(len(messages) - 2, 0, -1):
+            if messages[end].get("role") != "assistant":
+                continue
+            entry = await self._get(hashes[end])
+            if entry is not None:
+                return ConversationMatch(entry, end + 1)
+        return None
+
+    async def remember(self, key: str, chat_id: str, parent_id: str, account_id: int, model: str):
+        """记录“消息历史 + 本次助手回复”对应的续接位置"""
+        if not settings.CONVERSATION_REUSE or not chat_id:
+            return
+        entry = ConversationEntry(chat_id, parent_id, account_id, model, time.time())
+        self._put(key, entry)
+        if self.persist:
+            try:
+                await db_manager.asave_conversation(key, chat_id, parent_id, account_id, model, entry.updated_at)
+            except Exception as e:
+                logger.error(f"保存会话索引失败: {e}")
+
+    async def _get(self, key: str) -> Optional[ConversationEntry]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self.persist:
+            row = await db_manager.aget_conversation(key)
+            if row:
+                entry = ConversationEntry(row["chat_id"], row["parent_id"], row["account_id"], row["model"], row["updated_at"])
+                self._put(key, entry)
+        if entry is None:
+            return None
+        if now - entry.updated_at > self.ttl:
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key: str, entry: ConversationEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def prune(self):
+        """清理持久层中过期的会话索引"""
+        if self.persist:
+            removed = await db_manager.aprune_conversations(time.time() - self.ttl)
+            if removed:
+                logger.info(f"🧹 清理过期会话索引 {removed} 条")
+
+
+conversation_store = ConversationStore()
@@ -3,14 +3,67 @@
 """
 数据库管理器 - 统一所有数据库操作
 唯一入口，避免锁竞争和数据不一致
+
+连接模型：
+- 一个持久写连接（写操作串行）+ 一个小的只读连接池
+- WAL 模式，读写互不阻塞
+- 同步方法可在线程中直接调用；异步代码使用 a* 方法，在专用线程池中执行，不阻塞事件循环
+- 账号表在内存中有一份写穿透缓存，账号读取为 O(1) 且不访问磁盘
 """
 
+import asyncio
+import queue
 import sqlite3
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
 from loguru import logger
 from app.core.config import settings
+from app.utils.jwt_utils import get_token_expiry
+
+# 缓存的账号字段（不含 discord_password 等热路径用不到的列）
+ACCOUNT_FIELDS = (
+    "id", "name", "data_dir", "token", "token_source", "created_at", "expires_at",
+    "discord_username", "is_active", "total_calls", "last_used_at", "last_refresh_at",
+)
+
+# 后来新增的日志列（旧数据库启动时自动补齐）
+LOG_EXTRA_COLUMNS = (
+    ("chat_ms", "INTEGER"),
+    ("ttfb_ms", "INTEGER"),
+    ("stream_ms", "INTEGER"),
+    ("bytes", "INTEGER"),
+    ("chunks", "INTEGER"),
+    ("message", "TEXT"),
+)
+
+
+class AccountRecord:
+    """紧凑的账号记录，兼容 dict 风格的 acc['name'] / acc.get('x') 访问"""
+    
+    __slots__ = ACCOUNT_FIELDS
+    
+    def __init__(self, row):
+        for field in ACCOUNT_FIELDS:
+            setattr(self, field, row[field])
+    
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+    
+    def to_dict(self):
+        return {field: getattr(self, field) for field in ACCOUNT_FIELDS}
+    
+    def __repr__(self):
+        return f"AccountRecord(id={self.id}, name={self.name!r}, is_active={self.is_active})"
 
 class DBManager:
     """数据库管理器 - 单例模式"""
@@ -31,15 +84,30 @@ class DBManager:
             return
             
         self.db_path = settings.DB_PATH
-        self._db_lock = threading.Lock()  # 数据库操作锁
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._write_lock = threading.Lock()  # 写连接锁（只串行化写操作）
+        self._writer = self._get_conn()
+        self._readers = queue.Queue()
+        for _ in range(settings.DB_READER_POOL_SIZE):
+            self._readers.put(self._get_conn())
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.DB_READER_POOL_SIZE + 1, thread_name_prefix="db"
+        )
+        self._listeners = []  # 账号变更监听器
+        # 账号写穿透缓存：按 id 索引，并按 (is_active, token_source) 分组
+        self._cache_lock = threading.Lock()
+        self._accounts = {}
+        self._all_accounts = ()
+        self._active_accounts = ()
+        self._accounts_by_state = {}
         self._init_database()
+        self._load_accounts()
         self._initialized = True
         logger.info("✅ 数据库管理器初始化完成")
     
     def _init_database(self):
         """初始化数据库表结构"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             
             # 账号表
@@ -69,56 +137,189 @@ class DBManager:
                     account_name TEXT,
                     model TEXT,
                     status TEXT,
-                    duration INTEGER
+                    duration INTEGER,
+                    chat_ms INTEGER,     -- 创建对话耗时（复用/预创建对话时为 0）
+                    ttfb_ms INTEGER,     -- 发起补全到收到首个上游事件
+                    stream_ms INTEGER,   -- 首个上游事件到响应结束
+                    bytes INTEGER,       -- 发送给客户端的字节数
+                    chunks INTEGER,      -- 发送给客户端的内容块数
+                    message TEXT         -- 失败原因
+                )
+            ''')
+            self._migrate_columns(cursor, "logs", LOG_EXTRA_COLUMNS)
+            
+            # 会话索引表（消息前缀哈希 -> Zai 对话位置）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    prefix_hash TEXT PRIMARY KEY,
+                    chat_id TEXT NOT NULL,
+                    parent_id TEXT,
+                    account_id INTEGER,
+                    model TEXT,
+                    updated_at REAL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at)")
+            
+            # 响应缓存表（请求哈希 -> 回复片段）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model TEXT,
+                    parts TEXT NOT NULL,  -- 回复内容片段的 JSON 数组
+                    created_at REAL,
+                    expires_at REAL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)")
+            
+            # 图片代理缓存索引（URL 哈希 -> 按内容哈希命名的文件）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS image_cache (
+                    url_key TEXT PRIMARY KEY,
+                    url TEXT,
+                    digest TEXT NOT NULL,
+                    content_type TEXT,
+                    size INTEGER,
+                    accessed_at REAL
                 )
             ''')
             
             conn.commit()
-            conn.close()
             logger.info("✅ 数据库表结构初始化完成")
     
+    @staticmethod
+    def _migrate_columns(cursor, table, columns):
+        """为旧版本数据库补齐新增的列"""
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in cursor.fetchall()}
+        for name, column_type in columns:
+            if name not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+                logger.info(f"🔧 数据表 {table} 新增列 {name}")
+    
     def _get_conn(self):
-        """获取数据库连接"""
-        return sqlite3.connect(self.db_path, check_same_thread=False)
+        """创建一个持久数据库连接（WAL、NORMAL 同步、忙等待超时）"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            timeout=settings.DB_BUSY_TIMEOUT / 1000,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(settings.DB_BUSY_TIMEOUT)}")
+        return conn
+    
+    @contextmanager
+    def _write(self):
+        """借用写连接（同一时间只有一个写者）"""
+        with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.rollback()
+                raise
+    
+    @contextmanager
+    def _read(self):
+        """从只读连接池借用一个连接"""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+    
+    async def _run(self, func, *args, **kwargs):
+        """在数据库线程池中执行同步方法"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    
+    def close(self):
+        """关闭线程池和所有持久连接"""
+        self._executor.shutdown(wait=True)
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        logger.info("🔒 数据库连接已关闭")
+    
+    @staticmethod
+    def _token_expires_at(token):
+        """过期时间优先取 Token 自身的 exp 声明，取不到时按 3 小时估算"""
+        expires = get_token_expiry(token) or (datetime.now() + timedelta(hours=3))
+        return expires.isoformat()
+    
+    # ==================== 账号缓存 ====================
+    
+    def _load_accounts(self):
+        """从磁盘完整加载账号缓存（仅初始化时调用）"""
+        columns = ", ".join(ACCOUNT_FIELDS)
+        with self._read() as conn:
+            rows = conn.execute(f"SELECT {columns} FROM accounts").fetchall()
+        with self._cache_lock:
+            self._accounts = {row["id"]: AccountRecord(row) for row in rows}
+            self._rebuild_account_index()
+    
+    def _sync_account(self, conn, account_id):
+        """写操作后用写连接重读单行，更新缓存（行不存在则移除）"""
+        columns = ", ".join(ACCOUNT_FIELDS)
+        row = conn.execute(f"SELECT {columns} FROM accounts WHERE id = ?", (account_id,)).fetchone()
+        with self._cache_lock:
+            if row:
+                self._accounts[account_id] = AccountRecord(row)
+            else:
+                self._accounts.pop(account_id, None)
+            self._rebuild_account_index()
+    
+    def _rebuild_account_index(self):
+        """重建只读索引（调用方持有 _cache_lock）；读者拿到的元组不会被原地修改"""
+        ordered = tuple(sorted(self._accounts.values(), key=lambda acc: acc.id))
+        by_state = {}
+        for acc in ordered:
+            by_state.setdefault((bool(acc.is_active), acc.token_source), []).append(acc)
+        self._all_accounts = ordered
+        self._active_accounts = tuple(acc for acc in ordered if acc.is_active)
+        self._accounts_by_state = {key: tuple(accs) for key, accs in by_state.items()}
+    
+    def add_listener(self, callback):
+        """注册账号变更监听器（账号增删、启停、Token 更新后回调）"""
+        self._listeners.append(callback)
+    
+    def _notify_accounts_changed(self):
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"账号变更回调失败: {e}")
     
     # ==================== 账号操作 ====================
     
     def get_all_accounts(self, active_only=False):
-        """获取所有账号"""
-        with self._db_lock:
-            conn = self._get_conn()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            if active_only:
-                cursor.execute("SELECT * FROM accounts WHERE is_active = 1 ORDER BY id ASC")
-            else:
-                cursor.execute("SELECT * FROM accounts ORDER BY id ASC")
-            
-            rows = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            return rows
+        """获取所有账号（来自缓存，按 id 升序，只读）"""
+        return self._active_accounts if active_only else self._all_accounts
+    
+    def get_accounts_by_source(self, token_source, active_only=True):
+        """按来源获取账号（来自缓存，只读）"""
+        accounts = self._accounts_by_state.get((True, token_source), ())
+        if not active_only:
+            accounts = tuple(sorted(
+                accounts + self._accounts_by_state.get((False, token_source), ()),
+                key=lambda acc: acc.id
+            ))
+        return accounts
     
     def get_account_by_id(self, account_id):
-        """根据ID获取账号"""
-        with self._db_lock:
-            conn = self._get_conn()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM accounts WHERE id = ?", (account_id,))
-            row = cursor.fetchone()
-            conn.close()
-            
-            return dict(row) if row else None
+        """根据ID获取账号（来自缓存）"""
+        return self._accounts.get(account_id)
     
     def create_account(self, name, token, data_dir, token_source='browser', discord_username=''):
         """创建账号"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             
             created_at = datetime.now().isoformat()
-            expires_at = (datetime.now() + timedelta(hours=3)).isoformat()
+            expires_at = self._token_expires_at(token)
             
             try:
                 cursor.execute('''
@@ -129,23 +330,24 @@ class DBManager:
                 
                 account_id = cursor.lastrowid
                 conn.commit()
-                conn.close()
+                self._sync_account(conn, account_id)
                 
                 logger.success(f"创建账号成功: {name} (ID: {account_id})")
-                return account_id
                 
             except sqlite3.IntegrityError as e:
                 logger.error(f"创建账号失败: {e}")
-                conn.close()
+                conn.rollback()
                 return None
+        
+        self._notify_accounts_changed()
+        return account_id
     
     def update_token(self, account_id, token):
         """更新账号Token"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             
-            expires_at = (datetime.now() + timedelta(hours=3)).isoformat()
+            expires_at = self._token_expires_at(token)
             now = datetime.now().isoformat()
             
             cursor.execute('''
@@ -155,13 +357,13 @@ class DBManager:
             ''', (token, expires_at, now, account_id))
             
             conn.commit()
-            conn.close()
+            self._sync_account(conn, account_id)
             logger.info(f"更新Token成功: ID {account_id}")
+        self._notify_accounts_changed()
     
     def update_stats(self, account_id):
         """更新账号统计"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             
             now = datetime.now().isoformat()
@@ -172,36 +374,39 @@ class DBManager:
             ''', (now, account_id))
             
             conn.commit()
-            conn.close()
+        
+        account = self._accounts.get(account_id)
+        if account is not None:
+            account.total_calls += 1
+            account.last_used_at = now
     
     def disable_account(self, account_id):
         """禁用账号"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             
             cursor.execute("UPDATE accounts SET is_active = 0 WHERE id = ?", (account_id,))
             
             conn.commit()
-            conn.close()
+            self._sync_account(conn, account_id)
             logger.info(f"禁用账号: ID {account_id}")
+        self._notify_accounts_changed()
     
     def delete_account(self, account_id):
         """删除账号"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             
             cursor.execute("DELETE FROM accounts WHERE id = ?", (account_id,))
             
             conn.commit()
-            conn.close()
+            self._sync_account(conn, account_id)
             logger.info(f"删除账号: ID {account_id}")
+        self._notify_accounts_changed()
     
     def toggle_account(self, account_id):
         """切换账号状态"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT is_active FROM accounts WHERE id = ?", (account_id,))
@@ -211,50 +416,194 @@ class DBManager:
                 new_status = 0 if row[0] else 1
                 cursor.execute("UPDATE accounts SET is_active = ? WHERE id = ?", (new_status, account_id))
                 conn.commit()
+                self._sync_account(conn, account_id)
                 
                 status_text = "启用" if new_status else "禁用"
                 logger.info(f"{status_text}账号: ID {account_id}")
             
-            conn.close()
+        self._notify_accounts_changed()
     
     # ==================== 日志操作 ====================
     
     def add_log(self, account_name, model, status, duration, message=None):
         """添加日志"""
-        with self._db_lock:
-            conn = self._get_conn()
+        self.add_logs([(datetime.now().isoformat(), account_name, model, status, duration,
+                        None, None, None, None, None, message)])
+    
+    def add_logs(self, rows):
+        """
+        批量添加日志（单个事务），rows 为元组列表：
+        (timestamp, account_name, model, status, duration, chat_ms, ttfb_ms, stream_ms, bytes, chunks, message)
+        """
+        if not rows:
+            return
+        with self._write() as conn:
             cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT INTO logs (timestamp, account_name, model, status, duration)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (datetime.now().isoformat(), account_name, model, status, duration))
+            cursor.executemany('''
+                INSERT INTO logs (timestamp, account_name, model, status, duration,
+                                  chat_ms, ttfb_ms, stream_ms, bytes, chunks, message)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
             
             conn.commit()
-            conn.close()
     
     def get_recent_logs(self, limit=20):
         """获取最近日志"""
-        with self._db_lock:
-            conn = self._get_conn()
-            conn.row_factory = sqlite3.Row
+        with self._read() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT * FROM logs ORDER BY id DESC LIMIT ?", (limit,))
             
-            rows = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            return rows
+            return [dict(row) for row in cursor.fetchall()]
     
     def clear_logs(self):
         """清空日志"""
-        with self._db_lock:
-            conn = self._get_conn()
+        with self._write() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM logs")
             conn.commit()
-            conn.close()
             logger.info("日志已清空")
 
+    # ==================== 会话索引 ====================
+    
+    def save_conversation(self, prefix_hash, chat_id, parent_id, account_id, model, updated_at):
+        """保存会话索引"""
+        with self._write() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO conversations (prefix_hash, chat_id, parent_id, account_id, model, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (prefix_hash, chat_id, parent_id, account_id, model, updated_at))
+            conn.commit()
+    
+    def get_conversation(self, prefix_hash):
+        """根据消息前缀哈希获取会话索引"""
+        with self._read() as conn:
+            row = conn.execute("SELECT * FROM conversations WHERE prefix_hash = ?", (prefix_hash,)).fetchone()
+            return dict(row) if row else None
+    
+    def prune_conversations(self, before):
+        """删除 updated_at 早于 before（时间戳）的会话索引，返回删除条数"""
+        with self._write() as conn:
+            cursor = conn.execute("DELETE FROM conversations WHERE updated_at < ?", (before,))
+            conn.commit()
+            return cursor.rowcount
+    
+    # ==================== 响应缓存 ====================
+    
+    def save_cached_response(self, cache_key, model, parts, created_at, expires_at):
+        """保存一条响应缓存，parts 为已序列化的 JSON 数组"""
+        with self._write() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO response_cache (cache_key, model, parts, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (cache_key, model, parts, created_at, expires_at))
+            conn.commit()
+    
+    def get_cached_response(self, cache_key, now):
+        """获取未过期的响应缓存"""
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT * FROM response_cache WHERE cache_key = ? AND expires_at > ?", (cache_key, now)
+            ).fetchone()
+            return dict(row) if row else None
+    
+    def save_cached_image(self, url_key, url, digest, content_type, size, accessed_at):
+        """保存一条图片缓存索引"""
+        with self._write() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO image_cache (url_key, url, digest, content_type, size, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (url_key, url, digest, content_type, size, accessed_at))
+            conn.commit()
+    
+    def get_cached_images(self):
+        """全部图片缓存索引，按最近访问时间从旧到新"""
+        with self._read() as conn:
+            rows = conn.execute("SELECT * FROM image_cache ORDER BY accessed_at").fetchall()
+            return [dict(row) for row in rows]
+    
+    def touch_cached_image(self, url_key, accessed_at):
+        with self._write() as conn:
+            conn.execute("UPDATE image_cache SET accessed_at = ? WHERE url_key = ?", (accessed_at, url_key))
+            conn.commit()
+    
+    def delete_cached_images(self, url_keys):
+        with self._write() as conn:
+            conn.executemany("DELETE FROM image_cache WHERE url_key = ?", [(key,) for key in url_keys])
+            conn.commit()
+    
+    def prune_cached_responses(self, now):
+        """删除已过期的响应缓存，返回删除条数"""
+        with self._write() as conn:
+            cursor = conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            conn.commit()
+            return cursor.rowcount
+    
+    # ==================== 异步接口（在线程池中执行，不阻塞事件循环） ====================
+    
+    async def aget_all_accounts(self, active_only=False):
+        return self.get_all_accounts(active_only)  # 读缓存，无需进线程池
+    
+    async def aget_account_by_id(self, account_id):
+        return self.get_account_by_id(account_id)  # 读缓存，无需进线程池
+    
+    async def acreate_account(self, name, token, data_dir, token_source='browser', discord_username=''):
+        return await self._run(self.create_account, name, token, data_dir, token_source, discord_username)
+    
+    async def aupdate_token(self, account_id, token):
+        return await self._run(self.update_token, account_id, token)
+    
+    async def aupdate_stats(self, account_id):
+        return await self._run(self.update_stats, account_id)
+    
+    async def adisable_account(self, account_id):
+        return await self._run(self.disable_account, account_id)
+    
+    async def adelete_account(self, account_id):
+        return await self._run(self.delete_account, account_id)
+    
+    async def atoggle_account(self, account_id):
+        return await self._run(self.toggle_account, account_id)
+    
+    async def aadd_logs(self, rows):
+        return await self._run(self.add_logs, rows)
+    
+    async def aget_recent_logs(self, limit=20):
+        return await self._run(self.get_recent_logs, limit)
+    
+    async def aclear_logs(self):
+        return await self._run(self.clear_logs)
+    
+    async def asave_conversation(self, prefix_hash, chat_id, parent_id, account_id, model, updated_at):
+        return await self._run(self.save_conversation, prefix_hash, chat_id, parent_id, account_id, model, updated_at)
+    
+    async def aget_conversation(self, prefix_hash):
+        return await self._run(self.get_conversation, prefix_hash)
+    
+    async def aprune_conversations(self, before):
+        return await self._run(self.prune_conversations, before)
+    
+    async def asave_cached_image(self, url_key, url, digest, content_type, size, accessed_at):
+        return await self._run(self.save_cached_image, url_key, url, digest, content_type, size, accessed_at)
+    
+    async def aget_cached_images(self):
+        return await self._run(self.get_cached_images)
+    
+    async def atouch_cached_image(self, url_key, accessed_at):
+        return await self._run(self.touch_cached_image, url_key, accessed_at)
+    
+    async def adelete_cached_images(self, url_keys):
+        return await self._run(self.delete_cached_images, url_keys)
+    
+    async def asave_cached_response(self, cache_key, model, parts, created_at, expires_at):
+        return await self._run(self.save_cached_response, cache_key, model, parts, created_at, expires_at)
+    
+    async def aget_cached_response(self, cache_key, now):
+        return await self._run(self.get_cached_response, cache_key, now)
+    
+    async def aprune_cached_responses(self, now):
+        return await self._run(self.prune_cached_responses, now)
+
 # 全局实例
 db_manager = DBManager()
\ No newline at end of file
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片代理缓存 - /img-proxy 的流式转发与磁盘缓存
+
+架构原则：
+- 共用一个连接池，上游字节边下载边转发，不在内存中缓冲整张图片
+- 下载完成后按内容的 sha256 命名存入 media/proxy/（相同图片只存一份），
+  URL 到文件的索引存在 SQLite；总大小超过上限时按最近最少使用淘汰
+- 放在子目录中，ImageManager 每 30 分钟的清理只删除 media/ 下的文件，不会波及缓存
+- 同一 URL 同时只下载一次：下载写入临时文件，内存中只保留最近写入的一小段（TAIL_BYTES），
+  跟上进度的请求从内存读取，落后的请求从临时文件读取；
+  下载与任何一个客户端的读取速度无关，客户端中途断开也会下载完并入缓存
+- 命中缓存时以内容哈希作为 ETag，支持 If-None-Match（304）与单段 Range（206）；
+  未命中时内容哈希要到下载结束才知道，响应声明 Accept-Ranges: none
+- 文件读写都放到线程中执行，不阻塞事件循环
+"""
+
+import asyncio
+import hashlib
+import os
+import secrets
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+import httpx
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from loguru import logger
+from app.core.config import settings
+from app.core.db_manager import db_manager
+
+CACHE_DIR = os.path.join("media", "proxy")
+READ_SIZE = 64 * 1024
+TAIL_BYTES = 1024 * 1024  # 每个下载在内存中保留的最近片段上限（已写入临时文件的部分）
+TOUCH_INTERVAL = 600  # 访问时间最多每 10 分钟写回一次数据库
+
+PROXY_HEADERS = {
+    "Cache-Control": "public, max-age=3600",  # 缓存1小时
+    "Access-Control-Allow-Origin": "*",      # 允许跨域访问
+    "Access-Control-Allow-Methods": "GET, OPTIONS",   # 允许GET和OPTIONS方法
+    "Access-Control-Allow-Headers": "*",      # 允许所有头部
+    "Access-Control-Allow-Credentials": "false",  # 不包含凭据
+}
+
+RANGE_UNSATISFIABLE = "unsatisfiable"
+
+
+def _read_at(handle, offset: int, size: int) -> bytes:
+    handle.seek(offset)
+    return handle.read(size)
+
+
+def _write_all(handle, chunk: bytes):
+    handle.write(chunk)
+    handle.flush()  # 落后的读者要能从另一个句柄读到
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match 比较（弱比较，支持 * 与多个值）"""
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.replace("W/", "", 1) == etag:
+            return True
+    return False
+
+
+def _parse_range(header: Optional[str], size: int):
+    """
+    解析单段 Range：返回 (start, end)（含 end），不可满足时返回 RANGE_UNSATISFIABLE，
+    无法解析或多段时返回 None（按规范可以忽略 Range 返回完整内容）
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return RANGE_UNSATISFIABLE
+            start, end = max(size - suffix, 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return RANGE_UNSATISFIABLE
+    return start, end
+
+
+class CachedImage:
+    """一条缓存索引"""
+
+    __slots__ = ("url_key", "url", "digest", "content_type", "size", "accessed_at")
+
+    def __init__(self, url_key: str, url: str, digest: str, content_type: str, size: int, accessed_at: float):
+        self.url_key = url_key
+        self.url = url
+        self.digest = digest
+        self.content_type = content_type
+        self.size = size
+        self.accessed_at = accessed_at  # 最近一次写回数据库的访问时间
+
+    @property
+    def path(self) -> str:
+        return os.path.join(CACHE_DIR, self.digest)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest}"'
+
+
+class _Download:
+    """
+    一次正在进行的下载：[tail_start, written) 的片段在内存中，之前的部分只在临时文件中；
+    只有已写入文件的片段才会从内存中丢弃
+    """
+
+    __slots__ = ("url", "url_key", "path", "ready", "content_type", "content_length", "tail", "tail_start",
+                 "tail_bytes", "written", "flushed", "done", "error", "spool_error", "discard", "readers", "_changed")
+
+    def __init__(self, url: str, url_key: str):
+        self.url = url
+        self.url_key = url_key
+        self.path = os.path.join(CACHE_DIR, f".{url_key}.{secrets.token_hex(4)}.part")
+        self.ready = asyncio.get_running_loop().create_future()  # 收到上游响应头且临时文件已创建
+        self.content_type = "image/jpeg"
+        self.content_length: Optional[str] = None
+        self.tail = deque()  # (offset, chunk)
+        self.tail_start = 0
+        self.tail_bytes = 0
+        self.written = 0  # 已收到的字节数
+        self.flushed = 0  # 已写入临时文件的字节数
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.spool_error: Optional[Exception] = None  # 写临时文件失败：不入缓存，落后的读者无法继续
+        self.discard = False  # 不入缓存，最后一个读者结束后删除临时文件
+        self.readers = 0
+        self._changed = asyncio.Event()
+
+    def append(self, chunk: bytes):
+        self.tail.append((self.written, chunk))
+        self.tail_bytes += len(chunk)
+        self.written += len(chunk)
+        self.notify()
+
+    def trim(self):
+        """内存中的片段超过 TAIL_BYTES 时丢弃最早的、已写入文件的片段"""
+        while self.tail_bytes > TAIL_BYTES and len(self.tail) > 1:
+            offset, chunk = self.tail[0]
+            end = offset + len(chunk)
+            if self.spool_error is None and end > self.flushed:
+                break
+            self.tail.popleft()
+            self.tail_bytes -= len(chunk)
+            self.tail_start = end
+
+    def chunk_at(self, offset: int) -> bytes:
+        """内存中从 offset 开始的片段（offset 在 [tail_start, written) 内）"""
+        for start, chunk in self.tail:
+            if offset < start + len(chunk):
+                return chunk if offset == start else chunk[offset - start:]
+        return b""
+
+    def notify(self):
+        event, self._changed = self._changed, asyncio.Event()
+        event.set()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class ImageCache:
+    """图片代理缓存 - 单例使用"""
+
+    def __init__(self):
+        self.max_bytes = settings.IMAGE_CACHE_MAX_BYTES
+        self._entries: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self._blobs: Dict[str, list] = {}  # digest -> [size, 引用该文件的 URL 数]
+        self._bytes = 0
+        self._downloads: Dict[str, _Download] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=settings.IMAGE_PROXY_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=settings.IMAGE_PROXY_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.IMAGE_PROXY_MAX_CONNECTIONS,
+                ),
+            )
+        return self._client
+
+    # ==================== 启动与关闭 ====================
+
+    async def start(self):
+        """载入缓存索引，清理中断的下载和没有索引的文件"""
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        try:
+            rows = await db_manager.aget_cached_images()
+        except Exception as e:
+            logger.error(f"读取图片缓存索引失败: {e}")
+            rows = []
+        stale = []
+        for row in rows:
+            entry = CachedImage(row["url_key"], row["url"], row["digest"], row["content_type"], row["size"], row["accessed_at"])
+            if os.path.isfile(entry.path):
+                self._add(entry)
+            else:
+                stale.append(entry.url_key)
+        for name in os.listdir(CACHE_DIR):
+            if name not in self._blobs:
+                try:
+                    os.remove(os.path.join(CACHE_DIR, name))
+                except OSError as e:
+                    logger.error(f"删除图片缓存文件失败 {name}: {e}")
+        if stale:
+            await self._persist(db_manager.adelete_cached_images(stale))
+        logger.info(f"🖼️ 图片缓存已载入 {len(self._entries)} 条，共 {self._bytes / 1024 / 1024:.1f}MB")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+    # ==================== 请求处理 ====================
+
+    async def serve(self, request, url: str) -> Response:
+        """返回图片响应；上游返回错误状态时抛出 httpx.HTTPStatusError"""
+        url_key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        entry = self._entries.get(url_key)
+        if entry is not None:
+            if os.path.isfile(entry.path):
+                self.hits += 1
+                self._entries.move_to_end(url_key)
+                self._touch(entry)
+                return self._respond_cached(request, entry)
+            self._evict(url_key)  # 文件已被外部删除
+
+        download = self._downloads.get(url_key)
+        if download is None:
+            self.misses += 1
+            download = self._downloads[url_key] = _Download(url, url_key)
+            asyncio.create_task(self._download(download))
+        else:
+            self.collapsed += 1
+
+        download.readers += 1
+        try:
+            await asyncio.shield(download.ready)  # 一个请求被取消不影响其他等待者
+        except BaseException:
+            self._leave(download)
+            raise
+        headers = dict(PROXY_HEADERS)
+        headers["Accept-Ranges"] = "none"
+        if download.content_length is not None:
+            headers["Content-Length"] = download.content_length
+        return StreamingResponse(self._follow(download), media_type=download.content_type, headers=headers)
+
+    def _respond_cached(self, request, entry: CachedImage) -> Response:
+        headers = dict(PROXY_HEADERS, ETag=entry.etag)
+        headers["Accept-Ranges"] = "bytes"
+        if _etag_matches(request.headers.get("if-none-match"), entry.etag):
+            return Response(status_code=304, headers=headers)
+
+        if_range = request.headers.get("if-range")
+        byte_range = None
+        if if_range is None or if_range.strip() == entry.etag:
+            byte_range = _parse_range(request.headers.get("range"), entry.size)
+        if byte_range == RANGE_UNSATISFIABLE:
+            headers["Content-Range"] = f"bytes */{entry.size}"
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{entry.size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                self._read_range(entry.path, start, end - start + 1),
+                status_code=206, media_type=entry.content_type, headers=headers,
+            )
+        return FileResponse(entry.path, media_type=entry.content_type, headers=headers)
+
+    @staticmethod
+    async def _read_range(path: str, start: int, length: int):
+        f = await asyncio.to_thread(open, path, "rb")
+        try:
+            await asyncio.to_thread(f.seek, start)
+            while length > 0:
+                chunk = await asyncio.to_thread(f.read, min(READ_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def _follow(self, download: _Download):
+        """跟读下载：最近的片段从内存读取，落后于内存中的片段时从临时文件读取"""
+        handle = None
+        try:
+            offset = 0
+            while True:
+                if offset < download.tail_start:
+                    if download.spool_error is not None:
+                        raise download.spool_error
+                    if handle is None:
+                        handle = await asyncio.to_thread(open, download.path, "rb")
+                    size = min(READ_SIZE, download.tail_start - offset)
+                    chunk = await asyncio.to_thread(_read_at, handle, offset, size)
+                    if not chunk:
+                        raise OSError(f"图片临时文件被截断: {download.path}")
+                elif offset < download.written:
+                    chunk = download.chunk_at(offset)
+                elif download.done:
+                    if download.error is not None:
+                        raise download.error
+                    break
+                else:
+                    await download.wait()
+                    continue
+                offset += len(chunk)
+                yield chunk
+        finally:
+            if handle is not None:
+                handle.close()
+            self._leave(download)
+
+    def _leave(self, download: _Download):
+        download.readers -= 1
+        if download.done and download.discard and download.readers <= 0:
+            self._remove_file(download.path)
+
+    # ==================== 下载与入库 ====================
+
+    async def _download(self, download: _Download):
+        hasher = hashlib.sha256()
+        f = None
+        complete = False
+        try:
+            async with self._get_client().stream("GET", download.url) as response:
+                response.raise_for_status()
+                download.content_type = response.headers.get("content-type", "image/jpeg")
+                if "content-encoding" not in response.headers:
+                    download.content_length = response.headers.get("content-length")
+                f = await asyncio.to_thread(open, download.path, "wb")
+                download.ready.set_result(None)
+                async for chunk in response.aiter_bytes():
+                    if not chunk:
+                        continue
+                    download.append(chunk)  # 先交给读者，再写文件
+                    hasher.update(chunk)
+                    if download.spool_error is None:
+                        try:
+                            await asyncio.to_thread(_write_all, f, chunk)
+                            download.flushed = download.written
+                        except OSError as e:
+                            download.spool_error = e
+                            logger.error(f"图片写入临时文件失败 {download.url}: {e}")
+                    download.trim()
+            complete = True
+        except Exception as e:
+            download.error = e
+            if not download.ready.done():
+                download.ready.set_exception(e)
+                download.ready.exception()  # 等待者都已离开时避免 "exception was never retrieved"
+            else:
+                logger.error(f"图片下载中断 {download.url}: {e}")
+        finally:
+            if f is not None:
+                try:
+                    await asyncio.to_thread(f.close)
+                except OSError as e:
+                    download.spool_error = download.spool_error or e
+            download.discard = True
+            if complete and download.spool_error is None:
+                try:
+                    download.discard = not self._store(download, hasher.hexdigest())
+                except Exception as e:
+                    logger.error(f"图片写入缓存失败 {download.url}: {e}")
+            download.done = True
+            download.notify()
+            if self._downloads.get(download.url_key) is download:
+                del self._downloads[download.url_key]
+            if download.discard and download.readers <= 0:
+                self._remove_file(download.path)
+
+    def _store(self, download: _Download, digest: str) -> bool:
+        """下载完成：临时文件改名为内容哈希并登记索引，返回是否入缓存"""
+        size = download.written
+        if not size or size > self.max_bytes:
+            return False
+        entry = CachedImage(download.url_key, download.url, digest, download.content_type, size, time.time())
+        if digest in self._blobs:
+            self._remove_file(download.path)  # 相同内容已缓存（已打开的文件句柄仍可读）
+        else:
+            os.replace(download.path, entry.path)
+        download.path = entry.path  # 还未打开文件的读者改读正式文件
+        self._add(entry)
+        asyncio.create_task(self._persist(db_manager.asave_cached_image(
+            entry.url_key, entry.url, entry.digest, entry.content_type, entry.size, entry.accessed_at
+        )))
+        return True
+
+    def _add(self, entry: CachedImage):
+        if entry.url_key in self._entries:
+            self._evict(entry.url_key, persist=False)
+        self._entries[entry.url_key] = entry
+        blob = self._blobs.get(entry.digest)
+        if blob is None:
+            self._blobs[entry.digest] = [entry.size, 1]
+            self._bytes += entry.size
+        else:
+            blob[1] += 1
+        evicted = []
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._evict(oldest, persist=False)
+            evicted.append(oldest)
+        if evicted:
+            logger.info(f"🧹 图片缓存超出上限，淘汰 {len(evicted)} 条")
+            asyncio.create_task(self._persist(db_manager.adelete_cached_images(evicted)))
+
+    def _evict(self, url_key: str, persist: bool = True):
+        entry = self._entries.pop(url_key, None)
+        if entry is None:
+            return
+        blob = self._blobs.get(entry.digest)
+        if blob is not None:
+            blob[1] -= 1
+            if blob[1] <= 0:
+                del self._blobs[entry.digest]
+                self._bytes -= blob[0]
+                self._remove_file(entry.path)
+        if persist:
+            asyncio.create_task(self._persist(db_manager.adelete_cached_images([url_key])))
+
+    def _touch(self, entry: CachedImage):
+        now = time.time()
+        if now - entry.accessed_at > TOUCH_INTERVAL:
+            entry.accessed_at = now
+            asyncio.create_task(self._persist(db_manager.atouch_cached_image(entry.url_key, now)))
+
+    @staticmethod
+    async def _persist(awaitable):
+        try:
+            await awaitable
+        except Exception as e:
+            logger.error(f"更新图片缓存索引失败: {e}")
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"删除图片缓存文件失败 {path}: {e}")
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "downloads": len(self._downloads),
+            "hits": self.hits,
+            "misses": self.misses,
+            "collapsed": self.collapsed,
+        }
+
+
+image_cache = ImageCache()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求日志异步批量写入器
+
+架构原则：
+- 热路径只把日志放入有界内存队列，不做任何磁盘 IO
+- 后台任务按时间或条数触发，用 executemany 单事务落盘
+- 队列满时丢弃并计数，绝不阻塞请求
+- 停止时等待正在进行的落盘完成，超时才取消，取消时未写入的日志计入丢弃
+"""
+
+import asyncio
+from collections import deque
+from datetime import datetime
+from loguru import logger
+from app.core.config import settings
+from app.core.db_manager import db_manager
+
+STOP_TIMEOUT = 10.0  # 停止时等待后台落盘结束的最长时间（秒）
+
+
+class LogWriter:
+    """请求日志写入器 - 单例使用"""
+
+    def __init__(self):
+        self.max_queue = settings.LOG_QUEUE_SIZE
+        self.batch_size = settings.LOG_BATCH_SIZE
+        self.flush_interval = settings.LOG_FLUSH_INTERVAL
+        self._queue = deque()
+        self._wakeup = None  # asyncio.Event，在 start() 中于事件循环内创建
+        self._task = None
+        self._stopping = False
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def submit(self, account_name, model, status, duration, chat_ms=None, ttfb_ms=None,
+               stream_ms=None, bytes_sent=None, chunks=None, message=None):
+        """
+        提交一条日志（非阻塞），队列已满时返回 False
+        duration 为请求总耗时，其余为各阶段耗时及传输量（未经历的阶段为 None）
+        """
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return False
+        self._queue.append((datetime.now().isoformat(), account_name, model, status, duration,
+                            chat_ms, ttfb_ms, stream_ms, bytes_sent, chunks, message))
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        """启动后台落盘任务"""
+        if self._task is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info("📝 日志写入器启动")
+
+    async def stop(self):
+        """停止后台任务并落盘剩余日志；后台任务在 STOP_TIMEOUT 秒内没有结束才取消"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout=STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ 日志落盘超过 {STOP_TIMEOUT:g} 秒未完成，取消后台任务")
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+            self._task = None
+        await self.flush()
+        logger.info(f"📝 日志写入器停止 (写入 {self.written} 条, 丢弃 {self.dropped} 条)")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """把当前队列中的日志一次性写入数据库"""
+        while self._queue:
+            rows = [self._queue.popleft() for _ in range(min(len(self._queue), self.batch_size))]
+            try:
+                await db_manager.aadd_logs(rows)
+                self.written += len(rows)
+                self.flushes += 1
+            except asyncio.CancelledError:
+                self.dropped += len(rows)  # 已出队但不确定是否写入
+                logger.warning(f"日志落盘被取消，{len(rows)} 条计为丢弃")
+                raise
+            except Exception as e:
+                self.dropped += len(rows)
+                logger.error(f"批量写入日志失败 ({len(rows)} 条): {e}")
+
+    def stats(self):
+        return {
+            "queued": len(self._queue),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+        }
+
+
+log_writer = LogWriter()
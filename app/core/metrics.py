@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行指标 - 以 Prometheus 文本格式导出计数器、仪表和直方图
+
+架构原则：
+- 所有记录都发生在事件循环线程内，只做字典查找和整数加法，不加锁
+- 直方图按桶存非累计计数，累计与格式化推迟到抓取时
+- 账号池、日志队列等状态类指标由采集回调在抓取时现算，热路径不维护
+"""
+
+import bisect
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+from loguru import logger
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, object] = {}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Counter(_Metric):
+    """只增计数器"""
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        values = self._values
+        values[label_values] = values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        values = self._values
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def replace(self, samples: Dict[Tuple, object]):
+        """整体替换所有样本（采集回调使用，已消失的标签组合随之移除）"""
+        self._values = dict(samples)
+
+
+class Histogram(_Metric):
+    """分桶直方图"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        state = self._values.get(label_values)
+        if state is None:
+            state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _render_samples(self) -> List[str]:
+        lines = []
+        bounds = self.buckets + (float("inf"),)
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class StreamStats:
+    """单次响应的流统计，由 Provider 在转发时填写"""
+
+    __slots__ = ("first_chunk_at", "finished_at", "chunks", "bytes", "completion_tokens")
+
+    def __init__(self):
+        self.first_chunk_at = 0.0
+        self.finished_at = 0.0
+        self.chunks = 0
+        self.bytes = 0
+        self.completion_tokens = 0
+
+    def on_content(self, tokens: int):
+        if not self.chunks:
+            self.first_chunk_at = time.time()
+        self.chunks += 1
+        self.completion_tokens += tokens
+
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+
+class MetricsRegistry:
+    """指标注册表 - 单例使用"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+        # model 标签只取已知模型（/v1/models 列表），其余归为 other，避免客户端随意传值制造无限时间序列
+        self.known_models = frozenset()
+
+        # 请求
+        self.requests = self.counter("zai_requests_total", "Chat completion requests by model and outcome", ("model", "outcome"))
+        self.upstream_errors = self.counter("zai_upstream_errors_total", "Upstream failures by HTTP status (or error type)", ("status",))
+        self.sse_parse_errors = self.counter("zai_sse_parse_errors_total", "Upstream SSE events that could not be parsed, by kind", ("kind",))
+        self.inflight_streams = self.gauge("zai_inflight_streams", "Responses currently being relayed to clients")
+
+        # 响应缓存
+        self.cache_lookups = self.counter("zai_response_cache_lookups_total", "Response cache lookups by result", ("result",))
+
+        # 准入控制
+        self.admission_queued = self.gauge("zai_admission_queued", "Requests waiting for admission by lane", ("lane",))
+        self.admission_rejected = self.counter("zai_admission_rejected_total", "Requests shed by admission control", ("lane", "reason"))
+        self.admission_wait = self.histogram("zai_admission_wait_seconds", "Time spent queued before admission", ("lane",), LATENCY_BUCKETS)
+
+        # 延迟
+        self.ttft = self.histogram("zai_ttft_seconds", "Time from request arrival to the first content chunk", ("model", "account"), LATENCY_BUCKETS)
+        self.stream_duration = self.histogram("zai_stream_duration_seconds", "Time from request arrival to the end of the response", ("model", "account"), LATENCY_BUCKETS)
+        self.tokens_per_second = self.histogram("zai_tokens_per_second", "Estimated completion tokens per second after the first chunk", ("model", "account"), RATE_BUCKETS)
+
+        # 账号与 Token 刷新
+        self.accounts = self.gauge("zai_accounts", "Accounts by pool state", ("state",))
+        self.refreshes = self.counter("zai_token_refresh_total", "Token refresh attempts by outcome", ("outcome",))
+        self.refresh_duration = self.histogram("zai_token_refresh_duration_seconds", "Browser token refresh duration", ("outcome",), LATENCY_BUCKETS)
+
+        # 后台组件
+        self.component = self.gauge("zai_component_stat", "Counters reported by background components", ("component", "stat"))
+
+    def counter(self, name, help_text, labels=()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()) -> Gauge:
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def model_label(self, model) -> str:
+        return model if model in self.known_models else "other"
+
+    def count_request(self, model, outcome: str):
+        self.requests.inc(self.model_label(model), outcome)
+
+    def observe_stream(self, model: str, account: str, started: float, stats: StreamStats):
+        """记录一次完整响应的 TTFT、总耗时与生成速率"""
+        model = self.model_label(model)
+        finished = stats.finished_at or time.time()
+        self.stream_duration.observe(finished - started, model, account)
+        if stats.chunks:
+            self.ttft.observe(stats.first_chunk_at - started, model, account)
+            generation = finished - stats.first_chunk_at
+            if generation > 0 and stats.completion_tokens:
+                self.tokens_per_second.observe(stats.completion_tokens / generation, model, account)
+
+    def add_collector(self, collector: Callable[[], None]):
+        """注册抓取时调用的采集回调（用于更新状态类 Gauge）"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"指标采集回调出错: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+响应缓存 - 相同的确定性请求直接回放已缓存的回复
+
+架构原则：
+- 以规范化后的 (模型, 消息, 采样参数) 的 sha256 为键，stream 与否共用同一条缓存
+- 内存 LRU 按回复字节数限制容量，SQLite 为可选的持久层，两层都有 TTL
+- 缓存的是回复的内容片段，命中时按 stream 回放为 SSE 流或单个 JSON
+- 默认关闭；开启后默认只缓存 temperature 为 0 的请求，请求头可单次绕过
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from loguru import logger
+from app.core.config import settings
+from app.core.db_manager import db_manager
+from app.core.metrics import metrics
+
+# 参与缓存键的采样参数（stream 不影响回复内容，不计入）
+SAMPLING_PARAMS = (
+    "temperature", "top_p", "max_tokens", "max_completion_tokens", "stop", "seed",
+    "presence_penalty", "frequency_penalty", "n", "logit_bias", "response_format",
+    "tools", "tool_choice", "reasoning_effort",
+)
+
+
+def request_fingerprint(request_data: dict) -> str:
+    """请求的规范化哈希：模型 + 消息 + 采样参数"""
+    canonical = {
+        "model": request_data.get("model", settings.DEFAULT_MODEL),
+        "messages": request_data.get("messages") or [],
+        "params": {name: request_data[name] for name in SAMPLING_PARAMS if request_data.get(name) is not None},
+    }
+    payload = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(request_data: dict) -> bool:
+    """temperature 明确为 0 且只要一个回复"""
+    temperature = request_data.get("temperature")
+    return isinstance(temperature, (int, float)) and temperature == 0 and request_data.get("n", 1) in (1, None)
+
+
+def bypass_requested(request) -> bool:
+    """X-Cache-Bypass: 1/true，或 Cache-Control: no-cache / no-store"""
+    if request.headers.get("x-cache-bypass", "").strip().lower() in ("1", "true", "yes"):
+        return True
+    cache_control = request.headers.get("cache-control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
+
+
+class CachedResponse:
+    """一条缓存的回复"""
+
+    __slots__ = ("model", "parts", "size", "expires_at")
+
+    def __init__(self, model: str, parts: List[str], expires_at: float):
+        self.model = model
+        self.parts = parts
+        self.size = sum(len(part.encode("utf-8")) for part in parts)
+        self.expires_at = expires_at
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+
+class ResponseCache:
+    """响应缓存 - 单例使用"""
+
+    def __init__(self):
+        self.max_bytes = settings.RESPONSE_CACHE_MAX_BYTES
+        self.ttl = settings.RESPONSE_CACHE_TTL
+        self.persist = settings.RESPONSE_CACHE_PERSIST
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+
+    def cache_key(self, request, request_data: dict) -> Optional[str]:
+        """请求可缓存时返回缓存键，否则返回 None"""
+        if not settings.RESPONSE_CACHE_ENABLED or bypass_requested(request):
+            return None
+        if settings.RESPONSE_CACHE_DETERMINISTIC_ONLY and not is_deterministic(request_data):
+            return None
+        return request_fingerprint(request_data)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove(key)
+            entry = None
+        if entry is None and self.persist:
+            try:
+                row = await db_manager.aget_cached_response(key, now)
+            except Exception as e:
+                logger.error(f"读取响应缓存失败: {e}")
+                row = None
+            if row:
+                entry = CachedResponse(row["model"], json.loads(row["parts"]), row["expires_at"])
+                self._put(key, entry)
+        if entry is None:
+            metrics.cache_lookups.inc("miss")
+            return None
+        if key in self._entries:  # 超过内存层容量的条目不会放入内存层
+            self._entries.move_to_end(key)
+        metrics.cache_lookups.inc("hit")
+        return entry
+
+    async def put(self, key: str, model: str, parts: List[str]):
+        """保存一次完整的回复"""
+        if not parts:
+            return
+        entry = CachedResponse(model, list(parts), time.time() + self.ttl)
+        if entry.size > self.max_bytes:
+            return
+        self._put(key, entry)
+        if self.persist:
+            try:
+                await db_manager.asave_cached_response(
+                    key, model, json.dumps(entry.parts, ensure_ascii=False), time.time(), entry.expires_at
+                )
+            except Exception as e:
+                logger.error(f"保存响应缓存失败: {e}")
+
+    def _put(self, key: str, entry: CachedResponse):
+        if entry.size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    async def replay(self, entry: CachedResponse, encoder):
+        """把缓存的片段回放为 SSE 块（bytes），片段划分与原始回复一致"""
+        interval = settings.RESPONSE_CACHE_REPLAY_INTERVAL_MS / 1000
+        for index, part in enumerate(entry.parts):
+            if interval and index:
+                await asyncio.sleep(interval)
+            yield encoder.encode(part)
+        yield encoder.finish("stop")
+
+    async def prune(self):
+        """清理持久层中过期的缓存"""
+        if self.persist:
+            removed = await db_manager.aprune_cached_responses(time.time())
+            if removed:
+                logger.info(f"🧹 清理过期响应缓存 {removed} 条")
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+response_cache = ResponseCache()
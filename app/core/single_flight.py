@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+单飞（single-flight）- 相同的请求同时到达时只向上游发起一次
+
+架构原则：
+- 以响应缓存同样的规范化请求哈希为键，键相同的并发请求挂到同一个 Flight 上，
+  第一个请求（领头请求）负责选择账号和打开上游，其余请求只订阅内容片段
+- 流式时上游由后台任务读取，内容片段写入每个订阅者自己的缓冲，
+  任何一个客户端读得慢都不会拖慢上游读取或其他订阅者；每个订阅者按自己的 stream 设置编码
+- 领头请求的客户端断开时，只要还有其他订阅者，上游继续读取；全部离开后才关闭上游
+- 领头请求在产出内容之前失败时，订阅者改为自行处理请求
+- 只适合确定性的生成参数，按模型显式开启（SINGLE_FLIGHT_MODELS）
+"""
+
+import asyncio
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from app.core.config import settings
+from app.core.response_cache import bypass_requested, request_fingerprint
+
+
+class Subscription:
+    """一个订阅者：独立的片段缓冲"""
+
+    __slots__ = ("_flight", "_buffer", "_event", "closed")
+
+    def __init__(self, flight: "Flight", backlog: List[str]):
+        self._flight = flight
+        self._buffer = deque(backlog)  # 晚到的订阅者从头开始读
+        self._event = asyncio.Event()
+        self.closed = False
+
+    def _push(self, part: str):
+        self._buffer.append(part)
+        self._event.set()
+
+    def _wake(self):
+        self._event.set()
+
+    async def _wait(self):
+        self._event.clear()
+        await self._event.wait()
+
+    async def next(self) -> Optional[str]:
+        """下一个片段；流正常结束返回 None，领头请求失败时抛出其异常"""
+        while not self._buffer:
+            if self._flight.done:
+                if self._flight.error is not None:
+                    raise self._flight.error
+                return None
+            await self._wait()
+        return self._buffer.popleft()
+
+    async def wait_started(self) -> bool:
+        """等到有内容或流结束；领头请求在产出任何内容之前失败时返回 False"""
+        while not self._buffer and not self._flight.done:
+            await self._wait()
+        return bool(self._buffer) or self._flight.error is None
+
+    async def read_all(self) -> List[str]:
+        """读完全部片段（非流式订阅者使用）"""
+        parts = []
+        try:
+            while True:
+                part = await self.next()
+                if part is None:
+                    return parts
+                parts.append(part)
+        finally:
+            self.close()
+
+    async def stream(self, encoder):
+        """按 SSE 块（bytes）输出片段，结束时附带结束块与 [DONE]"""
+        try:
+            while True:
+                part = await self.next()
+                if part is None:
+                    break
+                yield encoder.encode(part)
+            yield encoder.finish("stop")
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._flight._unsubscribe(self)
+
+
+class Flight:
+    """一次正在进行的上游请求"""
+
+    def __init__(self, registry: Dict[str, "Flight"], key: str, model: str):
+        self._registry = registry
+        self.key = key
+        self.model = model
+        self.parts: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.leader: Optional[Subscription] = None
+        self._subscribers = set()
+        self._task: Optional[asyncio.Task] = None
+        self._callbacks: List[Callable[[Optional[BaseException]], None]] = []
+
+    # relay()/collect() 的 capture 接口：按发送顺序追加内容片段并分发给订阅者
+    def append(self, part: str):
+        self.parts.append(part)
+        for subscription in self._subscribers:
+            subscription._push(part)
+
+    def extend(self, parts: List[str]):
+        for part in parts:
+            self.append(part)
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def __len__(self):
+        return len(self.parts)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self, self.parts)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+        if not self._subscribers and self._task is not None and not self.done:
+            self.finish(ConnectionAbortedError("所有订阅者均已断开"))
+
+    def start(self, generator) -> Subscription:
+        """在后台读取上游（relay 生成器，其 capture 为本 Flight），返回领头请求的订阅"""
+        self.leader = self.subscribe()
+        self._task = asyncio.create_task(self._pump(generator))
+        return self.leader
+
+    async def _pump(self, generator):
+        error = None
+        try:
+            async for _ in generator:  # 编码好的块由各订阅者自行生成，这里只驱动上游读取
+                pass
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            error = e
+        finally:
+            await generator.aclose()
+        self.finish(error)
+
+    def finish(self, error: Optional[BaseException] = None):
+        """结束 Flight（可重复调用）：唤醒所有订阅者，后续相同的请求不再挂到这里"""
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        if self._registry.get(self.key) is self:
+            del self._registry[self.key]
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        for subscription in self._subscribers:
+            subscription._wake()
+        for callback in self._callbacks:
+            try:
+                callback(error)
+            except Exception as e:
+                logger.error(f"单飞结束回调出错: {e}")
+
+
+class SingleFlight:
+    """单飞注册表 - 单例使用"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._models = {name.strip() for name in settings.SINGLE_FLIGHT_MODELS.split(",") if name.strip()}
+
+    def flight_key(self, request, request_data: dict, model: str) -> Optional[str]:
+        """请求可合并时返回键，否则返回 None"""
+        if not self._models or ("*" not in self._models and model not in self._models):
+            return None
+        if bypass_requested(request):
+            return None
+        return request_fingerprint(request_data)
+
+    def join(self, key: str, model: str) -> Tuple[Flight, bool]:
+        """返回 (Flight, 是否为领头请求)"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = self._flights[key] = Flight(self._flights, key, model)
+        return flight, True
+
+    @staticmethod
+    def finish(flight: Optional[Flight], error: Optional[BaseException] = None):
+        if flight is not None:
+            flight.finish(error)
+
+    @staticmethod
+    def hand_off(flight: Optional[Flight], on_done: Callable[[Optional[BaseException]], None]) -> bool:
+        """
+        领头请求的客户端断开时调用：还有其他订阅者则让上游继续读取，
+        on_done 在 Flight 结束时执行并返回 True；否则返回 False，由调用方结束 Flight 并关闭上游
+        """
+        if flight is None or flight.leader is None:
+            return False
+        flight.leader.close()  # 没有其他订阅者时这里就会结束 Flight
+        if flight.done:
+            return False
+        flight._callbacks.append(on_done)
+        logger.info(f"🔀 领头请求已断开，上游继续为 {len(flight._subscribers)} 个订阅者读取")
+        return True
+
+    def stats(self):
+        return {
+            "flights": len(self._flights),
+            "subscribers": sum(len(flight._subscribers) for flight in self._flights.values()),
+        }
+
+
+single_flight = SingleFlight()
@@ -1,5 +1,13 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, AsyncGenerator
+from typing import Dict, Any, AsyncGenerator, Optional
+
+class UpstreamError(Exception):
+    """上游请求失败（可换账号重试）"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after  # 限流时上游要求的等待秒数（未给出时为 None）
 
 class BaseProvider(ABC):
     @abstractmethod
@@ -8,4 +16,4 @@ class BaseProvider(ABC):
     
     @abstractmethod
     async def chat_completion(self, request_data: Dict[str, Any], token: str) -> AsyncGenerator[str, None]:
-        pass
\ No newline at end of file
+        pass
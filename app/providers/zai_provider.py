@@ -18,10 +18,132 @@ import urllib.parse
 import httpx
 import re
 import base64
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
 from loguru import logger
 from app.core.config import settings
-from app.utils.sse_utils import create_chat_completion_chunk
-from app.providers.base_provider import BaseProvider
+from app.core.metrics import metrics
+from app.utils.sse_parser import SSEDecoder, SSEEvent
+from app.utils.stream_coalescer import coalesce_deltas
+from app.utils.sse_utils import ChunkEncoder, create_chat_completion, create_chat_completion_chunk, estimate_prompt_tokens, estimate_tokens, loads_json
+from app.providers.base_provider import BaseProvider, UpstreamError
+
+# 模型 ID -> Zai 界面显示名称
+MODEL_DISPLAY_NAMES = {
+    "gemini-3-pro-image-preview": "Nano Banana Pro",
+    "gemini-2.5-pro": "Gemini 2.5 Pro",
+    "claude-opus-4-20250514": "Claude Opus 4",
+    "claude-sonnet-4-5-20250929": "Claude Sonnet 4.5",
+    "claude-sonnet-4-20250514": "Claude Sonnet 4",
+    "claude-haiku-4-5-20251001": "Claude Haiku 4.5",
+    "o1-2024-12-17": "o1",
+    "o3-pro-2025-06-10": "o3-pro",
+    "grok-4-1-fast-reasoning": "Grok 4.1 Fast",
+    "grok-4-0709": "Grok 4",
+    "o4-mini-2025-04-16": "o4-mini",
+    "gpt-5-2025-08-07": "GPT-5",
+    "gemini-2.5-flash-image": "Nano Banana"
+}
+
+
+class UpstreamStream:
+    """已收到首个 SSE 事件的上游流（已解码的事件先缓冲，其余继续从响应字节流解码）"""
+    
+    def __init__(self, response: httpx.Response, chunks, decoder: SSEDecoder, pending: List[SSEEvent],
+                 model: str, chat_id: str, message_id: str, chat_ms: int = 0, ttfb_ms: int = 0):
+        self.response = response
+        self.model = model
+        self.chat_id = chat_id
+        self.message_id = message_id  # 本次助手回复的节点 id，下一轮的 parent_id
+        self.chat_ms = chat_ms  # 创建对话耗时（续接/预创建对话时为 0）
+        self.ttfb_ms = ttfb_ms  # 发起补全请求到收到首个事件
+        self.opened_at = time.time()
+        self.on_close = None  # 关闭时调用一次（归还连接池占用）
+        self._chunks = chunks
+        self._decoder = decoder
+        self._pending = pending
+    
+    async def iter_events(self):
+        pending, self._pending = self._pending, []
+        for event in pending:
+            yield event
+        async for chunk in self._chunks:
+            for event in self._decoder.feed(chunk):
+                yield event
+        for event in self._decoder.close():
+            yield event
+    
+    async def aclose(self):
+        on_close, self.on_close = self.on_close, None
+        try:
+            await self.response.aclose()
+        finally:
+            if on_close is not None:
+                on_close()
+
+
+def _parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """
+    读取限流响应要求的等待秒数：Retry-After（秒数或 HTTP 日期），
+    其次是 X-RateLimit-Reset（剩余秒数或 Unix 时间戳）；非限流响应或没有这些头时返回 None
+    """
+    if response.status_code not in (429, 503):
+        return None
+    value = response.headers.get("retry-after")
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+    value = response.headers.get("x-ratelimit-reset")
+    if value:
+        try:
+            reset = float(value)
+        except ValueError:
+            return None
+        # 大于一年的数值视为时间戳
+        return max(reset - time.time(), 0.0) if reset > 365 * 86400 else reset
+    return None
+
+
+def _content_from_choices(chunk_data: dict) -> str:
+    """OpenAI 兼容格式：choices[0].delta.content"""
+    choices = chunk_data["choices"]
+    return (choices[0]["delta"].get("content") or "") if choices else ""
+
+
+def _content_from_top_level(chunk_data: dict) -> str:
+    """Zai 的新格式：直接在顶层有 content"""
+    return chunk_data.get("content") or ""
+
+
+def _content_generic(chunk_data: dict) -> str:
+    """逐一探测所有已知格式（识别格式之前，或快速路径不匹配时使用）"""
+    if chunk_data.get("choices"):
+        return chunk_data["choices"][0].get("delta", {}).get("content", "")
+    content = chunk_data.get("content", "")
+    if not content:
+        choices = chunk_data.get("choices", [])
+        if choices and "delta" in choices[0]:
+            content = choices[0]["delta"].get("content", "")
+    return content
+
+
+def _detect_content_shape(chunk_data):
+    """根据一个事件确定整条流的内容提取函数，无法判断时返回 None"""
+    if not isinstance(chunk_data, dict):
+        return None
+    if chunk_data.get("choices"):
+        return _content_from_choices
+    if "content" in chunk_data:
+        return _content_from_top_level
+    return None
+
 
 class ZaiProvider(BaseProvider):
     """
@@ -37,18 +159,199 @@ class ZaiProvider(BaseProvider):
     def __init__(self):
         self.base_url = settings.ZAI_BASE_URL
         self.default_model = settings.DEFAULT_MODEL
+        # 每个账号（按 Token 哈希区分）一个长连接池，由 lifespan 负责关闭
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None  # 创建连接池的事件循环（账号变更回调可能来自数据库线程）
+        # Token 失效后旧连接池上可能还有进行中的流：按连接池计数占用，最后一个流结束时才关闭
+        self._leases: Dict[httpx.AsyncClient, int] = {}
+        self._retired = set()  # 已失效、等待进行中的流结束的连接池
+        self._closing = set()  # 正在关闭连接池的任务
+        self._http2 = settings.UPSTREAM_HTTP2 and self._http2_available()
+        # Token 验证：结果缓存 (Token哈希 -> (是否有效, 过期时间))、进行中的验证、每个线程复用的 cloudscraper 会话
+        # 验证在多个工作线程中执行：缓存的写入与清理加锁，会话（requests.Session）不跨线程共享
+        self._verify_cache: Dict[str, Tuple[bool, float]] = {}
+        self._verify_cache_lock = threading.Lock()
+        self._verify_next_prune = 0.0
+        self._verify_inflight: Dict[str, asyncio.Future] = {}
+        self._verify_semaphore: Optional[asyncio.Semaphore] = None  # 首次使用时在事件循环内创建
+        self._scrapers = threading.local()
+    
+    @staticmethod
+    def _http2_available() -> bool:
+        """HTTP/2 依赖 h2 包，未安装时回退到 HTTP/1.1"""
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            logger.warning("⚠️ 未安装 h2，上游连接回退为 HTTP/1.1")
+            return False
+    
+    @staticmethod
+    def token_key(token: str) -> str:
+        """Token 的哈希标识（用于连接池、缓存的键，避免明文 Token 作键）"""
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+    
+    def get_client(self, token: str) -> httpx.AsyncClient:
+        """获取（必要时创建）该 Token 专属的上游连接池"""
+        key = self.token_key(token)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                http2=self._http2,
+                timeout=httpx.Timeout(settings.UPSTREAM_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE,
+                    keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+                ),
+            )
+            self._clients[key] = client
+            self._loop = asyncio.get_running_loop()
+            logger.debug(f"🔌 创建上游连接池 ({len(self._clients)} 个, http2={self._http2})")
+        return client
+    
+    def _acquire_client(self, token: str) -> httpx.AsyncClient:
+        """获取连接池并计入一次占用，用完后调用 _release_client"""
+        client = self.get_client(token)
+        self._leases[client] = self._leases.get(client, 0) + 1
+        return client
+    
+    def _release_client(self, client: httpx.AsyncClient):
+        count = self._leases.get(client, 0) - 1
+        if count > 0:
+            self._leases[client] = count
+            return
+        self._leases.pop(client, None)
+        if client in self._retired:
+            self._retired.discard(client)
+            self._close_client_soon(client)
+    
+    def release_stale_clients(self, live_tokens):
+        """
+        关闭已不属于任何账号的 Token 的连接池（Token 被替换或账号删除后调用，可在任意线程调用）
+        旧 Token 上还有进行中的流时，连接池在最后一个流结束后才关闭
+        """
+        if self._loop is None or self._loop.is_closed():
+            return
+        live = {self.token_key(token) for token in live_tokens if token}
+        self._loop.call_soon_threadsafe(self._release_keys, live)
+    
+    def _release_keys(self, live):
+        stale = [key for key in self._clients if key not in live]
+        for key in stale:
+            client = self._clients.pop(key)
+            if self._leases.get(client):
+                self._retired.add(client)
+            else:
+                self._close_client_soon(client)
+        if stale:
+            logger.debug(f"🔌 {len(stale)} 个连接池的 Token 已失效，进行中的流结束后关闭")
+    
+    def _close_client_soon(self, client: httpx.AsyncClient):
+        task = asyncio.create_task(self._close_client(client))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+    
+    @staticmethod
+    async def _close_client(client: httpx.AsyncClient):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"关闭上游连接池失败: {e}")
+    
+    async def close(self):
+        """关闭所有上游连接池（包括已失效但还有流未结束的）"""
+        clients = list(self._clients.values()) + list(self._retired)
+        self._clients.clear()
+        self._retired.clear()
+        for client in clients:
+            await self._close_client(client)
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+        logger.info(f"🔌 已关闭 {len(clients)} 个上游连接池")
         
     def verify_token(self, token: str) -> bool:
         """
-        验证Token是否有效
+        验证Token是否有效（同步版本，会阻塞调用线程）
         通过请求 /api/v1/chats/?page=1 接口测试
         """
-        import cloudscraper
+        if not token or len(token) < 50:
+            return False
         
+        cached = self._get_cached_verification(token)
+        if cached is not None:
+            return cached
+        return self._verify_blocking(token)
+    
+    async def averify_token(self, token: str, use_cache: bool = True) -> bool:
+        """
+        异步验证Token：带 TTL 结果缓存、同 Token 并发合并、全局并发上限
+        阻塞的 cloudscraper 请求在线程中执行，不阻塞事件循环
+        """
         if not token or len(token) < 50:
             return False
-            
-        scraper = cloudscraper.create_scraper()
+        
+        if use_cache:
+            cached = self._get_cached_verification(token)
+            if cached is not None:
+                return cached
+        
+        key = self.token_key(token)
+        inflight = self._verify_inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        
+        if self._verify_semaphore is None:
+            self._verify_semaphore = asyncio.Semaphore(settings.VERIFY_CONCURRENCY)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._verify_inflight[key] = future
+        try:
+            async with self._verify_semaphore:
+                result = await asyncio.to_thread(self._verify_blocking, token)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 标记异常已读取，避免无人等待时告警
+            raise
+        finally:
+            self._verify_inflight.pop(key, None)
+    
+    def _get_cached_verification(self, token: str) -> Optional[bool]:
+        entry = self._verify_cache.get(self.token_key(token))
+        if entry is None:
+            return None
+        is_valid, expires = entry
+        if expires < time.monotonic():
+            with self._verify_cache_lock:
+                self._verify_cache.pop(self.token_key(token), None)
+            return None
+        return is_valid
+    
+    def _cache_verification(self, token: str, is_valid: bool, ttl: float):
+        """写入验证结果，并定期清理已过期的条目（轮换掉的 Token 不会再被查询）"""
+        now = time.monotonic()
+        with self._verify_cache_lock:
+            self._verify_cache[self.token_key(token)] = (is_valid, now + ttl)
+            if now >= self._verify_next_prune:
+                self._verify_next_prune = now + settings.VERIFY_CACHE_TTL
+                for key in [key for key, (_, expires) in self._verify_cache.items() if expires < now]:
+                    del self._verify_cache[key]
+    
+    def _get_scraper(self):
+        """复用当前线程已通过 Cloudflare 校验的 cloudscraper 会话（requests.Session 不是线程安全的）"""
+        scraper = getattr(self._scrapers, "scraper", None)
+        if scraper is None:
+            import cloudscraper
+            scraper = self._scrapers.scraper = cloudscraper.create_scraper()
+        return scraper
+    
+    def _verify_blocking(self, token: str) -> bool:
+        """实际发起验证请求；只缓存明确的结果（200 / 401 / 403）"""
         headers = {
             "Authorization": f"Bearer {token}",
             "Accept": "application/json",
@@ -56,11 +359,16 @@ class ZaiProvider(BaseProvider):
         }
         
         try:
-            resp = scraper.get(f"{self.base_url}/api/v1/chats/?page=1", headers=headers, timeout=10)
-            return resp.status_code == 200
+            resp = self._get_scraper().get(f"{self.base_url}/api/v1/chats/?page=1", headers=headers, timeout=10)
         except Exception as e:
             logger.error(f"Token验证失败: {e}")
             return False
+        
+        is_valid = resp.status_code == 200
+        if is_valid or resp.status_code in (401, 403):
+            ttl = settings.VERIFY_CACHE_TTL if is_valid else settings.VERIFY_NEGATIVE_CACHE_TTL
+            self._cache_verification(token, is_valid, ttl)
+        return is_valid
 
     async def chat_completion(self, request_data: dict, token: str):
         """
@@ -86,69 +394,159 @@ class ZaiProvider(BaseProvider):
         2. POST /api/v1/chats/{chat_id} - 更新对话
         3. POST /api/chat/completions - 流式请求AI回复
         4. POST /api/chat/completed - 标记完成
+        
+        上游错误以错误块的形式返回；需要故障转移的调用方应使用
+        open_stream() + relay()，在首个事件到达前即可感知失败。
         """
-        if not token:
-            yield f"data: {json.dumps({'error': 'No token provided'})}\n\n"
+        model = request_data.get("model", self.default_model)
+        try:
+            upstream = await self.open_stream(request_data, token)
+        except (ValueError, UpstreamError) as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
             return
+        except Exception as e:
+            logger.error(f"API请求失败: {e}")
+            error_chunk = create_chat_completion_chunk("error", model, f"Error: {str(e)}")
+            yield f"data: {json.dumps(error_chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        
+        try:
+            async for chunk in self.relay(upstream):
+                yield chunk
+        except Exception as e:
+            logger.error(f"API请求失败: {e}")
+            error_chunk = create_chat_completion_chunk("error", model, f"Error: {str(e)}")
+            yield f"data: {json.dumps(error_chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+    
+    async def open_stream(self, request_data: dict, token: str, conversation=None, chat_id: Optional[str] = None) -> "UpstreamStream":
+        """
+        创建对话并打开上游流，直到收到第一个 SSE 事件才返回
+        
+        conversation 为会话索引的命中结果（含 chat_id / parent_id / delta_start）时，
+        跳过创建对话，直接在已有对话上追加，只发送新增的消息。
+        chat_id 为预创建的空对话时，同样跳过创建对话这一轮往返。
+        
+        失败时抛出 UpstreamError（可换账号重试）或 ValueError（请求本身有误）。
+        """
+        if not token:
+            raise UpstreamError("No token provided")
 
         model = request_data.get("model", self.default_model)
         messages = request_data.get("messages", [])
-        stream = request_data.get("stream", True)
         
         if not messages:
-            yield f"data: {json.dumps({'error': 'No messages provided'})}\n\n"
-            return
+            raise ValueError("No messages provided")
         
-        # 构造消息历史
-        user_msg_id = str(uuid.uuid4())
+        client = self._acquire_client(token)
+        try:
+            upstream = await self._open_stream(client, token, model, messages, conversation, chat_id)
+        except BaseException:
+            self._release_client(client)
+            raise
+        upstream.on_close = lambda: self._release_client(client)
+        return upstream
+    
+    async def _open_stream(self, client: httpx.AsyncClient, token: str, model: str, messages: list,
+                           conversation, chat_id: Optional[str]) -> "UpstreamStream":
+        """open_stream 的主体：在已占用的连接池上创建对话、发起补全并等待首个事件"""
         assistant_msg_id = str(uuid.uuid4())
-        timestamp = int(time.time())
-        user_content = messages[-1]["content"]
-        
-        # 根据模型名称设置模型显示名称
-        model_display_names = {
-            "gemini-3-pro-image-preview": "Nano Banana Pro",
-            "gemini-2.5-pro": "Gemini 2.5 Pro",
-            "claude-opus-4-20250514": "Claude Opus 4",
-            "claude-sonnet-4-5-20250929": "Claude Sonnet 4.5",
-            "claude-sonnet-4-20250514": "Claude Sonnet 4",
-            "claude-haiku-4-5-20251001": "Claude Haiku 4.5",
-            "o1-2024-12-17": "o1",
-            "o3-pro-2025-06-10": "o3-pro",
-            "grok-4-1-fast-reasoning": "Grok 4.1 Fast",
-            "grok-4-0709": "Grok 4",
-            "o4-mini-2025-04-16": "o4-mini",
-            "gpt-5-2025-08-07": "GPT-5",
-            "gemini-2.5-flash-image": "Nano Banana"
-        }
+        headers = self._build_headers(token)
+        chat_ms = 0
         
-        model_name = model_display_names.get(model, model)
+        if conversation is not None:
+            # 续接已有对话：只发送命中前缀之后的新消息
+            chat_id = conversation.chat_id
+            parent_id = conversation.parent_id
+            send_messages = messages[conversation.delta_start:]
+            logger.debug(f"🔗 续接对话 {chat_id}，发送 {len(send_messages)} 条新消息")
+        elif chat_id:
+            # 使用预创建的空对话：完整历史随补全请求发送
+            parent_id = None
+            send_messages = messages
+            logger.debug(f"🧺 使用预创建对话 {chat_id}")
+        else:
+            # 步骤1：创建新对话（包含完整的消息历史）
+            zai_messages, parent_id = self._build_message_tree(model, messages, assistant_msg_id)
+            chat_started = time.monotonic()
+            chat_id = await self._create_chat(client, headers, model, zai_messages, assistant_msg_id)
+            chat_ms = int((time.monotonic() - chat_started) * 1000)
+            send_messages = messages
         
-        # 构造 Zai.is 格式的消息对象
-        zai_messages = {
-            user_msg_id: {
-                "id": user_msg_id,
-                "parentId": None,
-                "childrenIds": [assistant_msg_id],
-                "role": "user",
-                "content": user_content,
-                "timestamp": timestamp,
-                "models": [model]
+        # 步骤2：发起流式补全
+        logger.debug(f"💬 步骤2: 发起AI请求 ({model})...")
+        completion_payload = {
+            "stream": True,
+            "model": model,
+            "messages": [
+                {"role": msg.get("role", "user"), "content": msg.get("content", ""), "extensions": {}}
+                for msg in send_messages
+            ],
+            "chat_id": chat_id,
+            "id": assistant_msg_id,
+            "parent_id": parent_id,
+            "params": {},
+            "tool_servers": [],
+            "features": {
+                "image_generation": False,
+                "code_interpreter": False,
+                "web_search": False
             },
-            assistant_msg_id: {
-                "parentId": user_msg_id,
-                "id": assistant_msg_id,
-                "childrenIds": [],
-                "role": "assistant",
-                "content": "",
-                "model": model,
-                "modelName": model_name,
-                "modelIdx": 0,
-                "timestamp": timestamp
+            "variables": {
+                "{{CURRENT_DATETIME}}": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "{{CURRENT_DATE}}": time.strftime("%Y-%m-%d"),
+                "{{CURRENT_TIME}}": time.strftime("%H:%M:%S"),
+                "{{CURRENT_WEEKDAY}}": time.strftime("%A"),
+                "{{CURRENT_TIMEZONE}}": "Asia/Shanghai",
+                "{{USER_LANGUAGE}}": "zh-CN"
             }
         }
         
-        headers = {
+        # 发起流式请求，并等待第一个事件，确认上游确实开始输出
+        resp2 = None
+        sent_at = time.monotonic()
+        try:
+            resp2 = await client.send(
+                client.build_request(
+                    "POST",
+                    f"{self.base_url}/api/chat/completions",
+                    json=completion_payload,
+                    headers=headers
+                ),
+                stream=True
+            )
+            if resp2.status_code >= 400:
+                await resp2.aread()
+                raise UpstreamError(
+                    f"补全请求失败: HTTP {resp2.status_code} {resp2.text[:200]}",
+                    status_code=resp2.status_code,
+                    retry_after=_parse_retry_after(resp2),
+                )
+            
+            logger.debug(f"📊 开始接收SSE流数据...")
+            chunks = resp2.aiter_bytes()
+            decoder = SSEDecoder()
+            async for chunk in chunks:
+                events = decoder.feed(chunk)
+                if events:
+                    ttfb_ms = int((time.monotonic() - sent_at) * 1000)
+                    return UpstreamStream(resp2, chunks, decoder, events, model, chat_id, assistant_msg_id, chat_ms, ttfb_ms)
+            events = decoder.close()
+            if events:
+                ttfb_ms = int((time.monotonic() - sent_at) * 1000)
+                return UpstreamStream(resp2, chunks, decoder, events, model, chat_id, assistant_msg_id, chat_ms, ttfb_ms)
+            raise UpstreamError("上游流在首个事件前结束")
+        except BaseException as e:
+            if resp2 is not None:
+                await resp2.aclose()
+            if isinstance(e, httpx.HTTPError):
+                raise UpstreamError(f"补全请求失败: {e}") from e
+            raise
+    
+    @staticmethod
+    def _build_headers(token: str) -> dict:
+        return {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
             "Accept": "*/*",
@@ -156,146 +554,234 @@ class ZaiProvider(BaseProvider):
             "Referer": "https://zai.is/",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36"
         }
-
-        async with httpx.AsyncClient(timeout=120) as client:
+    
+    @staticmethod
+    def _build_message_tree(model: str, messages: list, assistant_msg_id: str):
+        """
+        构造 Zai.is 格式的消息树：历史消息依次链接，末尾挂一个空的助手消息
+        返回 (消息字典, 助手消息的 parentId)
+        """
+        timestamp = int(time.time())
+        model_name = MODEL_DISPLAY_NAMES.get(model, model)
+        zai_messages = {}
+        parent_id = None
+        for msg in messages:
+            msg_id = str(uuid.uuid4())
+            node = {
+                "id": msg_id,
+                "parentId": parent_id,
+                "childrenIds": [],
+                "role": msg.get("role", "user"),
+                "content": msg.get("content", ""),
+                "timestamp": timestamp
+            }
+            if node["role"] == "user":
+                node["models"] = [model]
+            if parent_id is not None:
+                zai_messages[parent_id]["childrenIds"].append(msg_id)
+            zai_messages[msg_id] = node
+            parent_id = msg_id
+        
+        zai_messages[assistant_msg_id] = {
+            "parentId": parent_id,
+            "id": assistant_msg_id,
+            "childrenIds": [],
+            "role": "assistant",
+            "content": "",
+            "model": model,
+            "modelName": model_name,
+            "modelIdx": 0,
+            "timestamp": timestamp
+        }
+        zai_messages[parent_id]["childrenIds"].append(assistant_msg_id)
+        return zai_messages, parent_id
+    
+    async def _create_chat(self, client: httpx.AsyncClient, headers: dict, model: str, zai_messages: dict, current_id) -> str:
+        """POST /api/v1/chats/new 创建对话，返回 chat_id"""
+        logger.debug(f"📝 步骤1: 创建新对话 ({model})...")
+        new_chat_payload = {
+            "chat": {
+                "id": "",
+                "title": "新对话",
+                "models": [model],
+                "params": {},
+                "history": {
+                    "messages": zai_messages,
+                    "currentId": current_id
+                },
+                "messages": list(zai_messages.values()),
+                "tags": [],
+                "timestamp": int(time.time()) * 1000
+            },
+            "folder_id": None
+        }
+        
+        try:
+            resp1 = await client.post(
+                f"{self.base_url}/api/v1/chats/new",
+                json=new_chat_payload,
+                headers=headers
+            )
+        except httpx.HTTPError as e:
+            raise UpstreamError(f"创建对话失败: {e}") from e
+        
+        if resp1.status_code == 401:
+            raise UpstreamError("Token无效或已过期", status_code=401)
+        if resp1.status_code >= 400:
+            raise UpstreamError(
+                f"创建对话失败: HTTP {resp1.status_code}",
+                status_code=resp1.status_code,
+                retry_after=_parse_retry_after(resp1),
+            )
+        
+        try:
+            chat_id = resp1.json().get("id")
+        except (ValueError, AttributeError) as e:
+            # 200 但不是 JSON（如 Cloudflare 拦截页）：属于上游/账号问题，交给故障转移换账号
+            raise UpstreamError(f"创建对话失败: 响应不是有效的 JSON ({resp1.headers.get('content-type', '未知类型')})") from e
+        if not chat_id:
+            raise UpstreamError("创建对话失败: 响应中没有对话 ID")
+        logger.success(f"✅ 对话创建成功: {chat_id}")
+        return chat_id
+    
+    async def create_empty_chat(self, token: str, model: str) -> str:
+        """创建一个空对话（供预创建对话池使用）"""
+        client = self._acquire_client(token)
+        try:
+            return await self._create_chat(client, self._build_headers(token), model, {}, None)
+        finally:
+            self._release_client(client)
+    
+    async def _iter_contents(self, upstream: "UpstreamStream"):
+        """
+        解析上游 SSE 流，逐个产出非空的内容片段
+        首个可识别的事件确定负载格式，之后走对应的快速路径；格式不符时退回逐一探测
+        """
+        extract = None
+        async for event in upstream.iter_events():
+            data_str = event.data
+            if data_str == "[DONE]":
+                logger.debug(f"✅ SSE流结束标记收到")
+                break
+            if event.event == "error":
+                raise UpstreamError(f"上游返回错误事件: {data_str[:200]}")
+            
             try:
-                # 步骤1：创建新对话
-                logger.debug(f"📝 步骤1: 创建新对话 ({model})...")
-                new_chat_payload = {
-                    "chat": {
-                        "id": "",
-                        "title": "新对话",
-                        "models": [model],
-                        "params": {},
-                        "history": {
-                            "messages": zai_messages,
-                            "currentId": assistant_msg_id
-                        },
-                        "messages": list(zai_messages.values()),
-                        "tags": [],
-                        "timestamp": timestamp * 1000
-                    },
-                    "folder_id": None
-                }
-                
-                resp1 = await client.post(
-                    f"{self.base_url}/api/v1/chats/new",
-                    json=new_chat_payload,
-                    headers=headers
-                )
-                
-                if resp1.status_code == 401:
-                    yield f"data: {json.dumps({'error': 'Token无效或已过期'})}\n\n"
-                    return
+                chunk_data = loads_json(data_str)
+            except ValueError:
+                metrics.sse_parse_errors.inc("json")
+                logger.warning(f"无法解析的SSE数据: {data_str[:100]}")
+                continue
+            
+            # 记录原始响应数据用于调试
+            logger.opt(lazy=True).debug("🔍 原始响应数据: {}...", lambda: data_str[:200])
+            
+            if extract is None:
+                extract = _detect_content_shape(chunk_data)
+            try:
+                content = extract(chunk_data) if extract is not None else _content_generic(chunk_data)
+            except (KeyError, IndexError, TypeError, AttributeError):
+                try:
+                    content = _content_generic(chunk_data)
+                except (KeyError, IndexError, TypeError, AttributeError):
+                    metrics.sse_parse_errors.inc("shape")
+                    logger.warning(f"无法识别的SSE数据格式: {data_str[:100]}")
+                    continue
+            
+            if content:
+                logger.opt(lazy=True).debug("📝 处理内容片段: {}...", lambda: content[:200])
                 
-                resp1.raise_for_status()
-                chat_data = resp1.json()
-                chat_id = chat_data.get("id")
-                logger.success(f"✅ 对话创建成功: {chat_id}")
+                # 检查是否包含图片URL，如果是则记录检测到的图片
+                if "![image]" in content:
+                    logger.success(f"🖼️ 检测到图片URL: {content}")
                 
-                # 步骤2：发起流式补全
-                logger.debug(f"💬 步骤2: 发起AI请求 ({model})...")
-                completion_payload = {
-                    "stream": True,
-                    "model": model,
-                    "messages": [{"role": "user", "content": user_content, "extensions": {}}],
-                    "params": {},
-                    "tool_servers": [],
-                    "features": {
-                        "image_generation": False,
-                        "code_interpreter": False,
-                        "web_search": False
-                    },
-                    "variables": {
-                        "{{CURRENT_DATETIME}}": time.strftime("%Y-%m-%d %H:%M:%S"),
-                        "{{CURRENT_DATE}}": time.strftime("%Y-%m-%d"),
-                        "{{CURRENT_TIME}}": time.strftime("%H:%M:%S"),
-                        "{{CURRENT_WEEKDAY}}": time.strftime("%A"),
-                        "{{CURRENT_TIMEZONE}}": "Asia/Shanghai",
-                        "{{USER_LANGUAGE}}": "zh-CN"
-                    }
-                }
+                yield content
+    
+    async def relay(self, upstream: "UpstreamStream", hasher=None, stats=None, capture=None):
+        """
+        将已打开的上游流转换为 OpenAI 格式的 SSE 块（bytes），结束时关闭上游连接
+        hasher 不为空时，逐片写入回复内容（用于会话索引的增量哈希）
+        stats 不为空时（StreamStats），记录首块时间、块数与估算的 token 数
+        capture 不为空时（list），按发送顺序追加每个内容片段（用于响应缓存）
+        """
+        model = upstream.model
+        encoder = ChunkEncoder(f"chatcmpl-{uuid.uuid4()}", model)
+        total_chars = 0
+        has_image = False
+        
+        contents = self._iter_contents(upstream)
+        if settings.STREAM_COALESCE_WINDOW_MS > 0:
+            # 可选：合并窗口内的小片段，减少编码次数与 socket 写入
+            contents = coalesce_deltas(
+                contents, settings.STREAM_COALESCE_WINDOW_MS / 1000, settings.STREAM_COALESCE_MAX_BYTES
+            )
+        
+        try:
+            async for content in contents:
+                total_chars += len(content)
+                has_image = has_image or "![image]" in content
+                if hasher is not None:
+                    hasher.update(content.encode("utf-8"))
+                if stats is not None:
+                    stats.on_content(estimate_tokens(content))
+                if capture is not None:
+                    capture.append(content)
                 
-                # 发起流式请求
-                async with client.stream(
-                    "POST",
-                    f"{self.base_url}/api/chat/completions",
-                    json=completion_payload,
-                    headers=headers
-                ) as resp2:
-                    request_id = f"chatcmpl-{uuid.uuid4()}"
-                    full_content = ""
-                    
-                    logger.debug(f"📊 开始接收SSE流数据...")
-                    
-                    # 读取SSE流
-                    async for line in resp2.aiter_lines():
-                        if not line or line.startswith(":"):
-                            continue
-                        
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            
-                            if data_str == "[DONE]":
-                                logger.debug(f"✅ SSE流结束标记收到")
-                                break
-                            
-                            try:
-                                chunk_data = json.loads(data_str)
-                                
-                                # 记录原始响应数据用于调试
-                                logger.debug(f"🔍 原始响应数据: {json.dumps(chunk_data, ensure_ascii=False)[:200]}...")
-                                
-                                # 对于 Zai 的响应格式，没有 choices 字段，直接处理 content
-                                if "choices" in chunk_data and chunk_data["choices"]:
-                                    # 旧格式，保持兼容性
-                                    delta = chunk_data["choices"][0].get("delta", {})
-                                    content = delta.get("content", "")
-                                else:
-                                    # Zai 的新格式：直接在顶层有 content
-                                    content = chunk_data.get("content", "")
-                                    if not content:
-                                        # 检查是否有其他可能的字段
-                                        choices = chunk_data.get("choices", [])
-                                        if choices and "delta" in choices[0]:
-                                            content = choices[0]["delta"].get("content", "")
-                                
-                                if content:
-                                    logger.debug(f"📝 处理内容片段: {content[:200]}...")
-                                    
-                                    # 检查是否包含图片URL，如果是则记录检测到的图片
-                                    if "![image]" in content:
-                                        logger.success(f"🖼️ 检测到图片URL: {content}")
-                                    
-                                    full_content += content
-                                    
-                                    # 转换为OpenAI格式
-                                    openai_chunk = create_chat_completion_chunk(request_id, model, content)
-                                    
-                                    logger.debug(f"📤 发送SSE块: {json.dumps(openai_chunk, ensure_ascii=False)[:200]}...")
-                                    yield f"data: {json.dumps(openai_chunk)}\n\n"
-                            except Exception as e:
-                                logger.error(f"处理SSE数据时出错: {e}, 数据: {data_str[:100]}")
-                                # 继续处理其他数据
-                                pass
-                    
-                    # 发送结束标记
-                    final_chunk = create_chat_completion_chunk(request_id, model, "", "stop")
-                    yield f"data: {json.dumps(final_chunk)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    
-                    # 检查是否包含图片并记录
-                    if "![image]" in full_content:
-                        logger.success(f"✅ AI响应完成，包含图片，共 {len(full_content)} 字符")
-                    else:
-                        logger.success(f"✅ AI响应完成，共 {len(full_content)} 字符")
-
-            except Exception as e:
-                logger.error(f"API请求失败: {e}")
-                error_chunk = create_chat_completion_chunk("error", model, f"Error: {str(e)}")
-                yield f"data: {json.dumps(error_chunk)}\n\n"
-                yield "data: [DONE]\n\n"
+                # 转换为OpenAI格式
+                chunk = encoder.encode(content)
+                if stats is not None:
+                    stats.bytes += len(chunk)
+                yield chunk
+            
+            # 发送结束标记
+            final = encoder.finish("stop")
+            if stats is not None:
+                stats.finished_at = time.time()
+                stats.bytes += len(final)
+            yield final
+            
+            # 检查是否包含图片并记录
+            if has_image:
+                logger.success(f"✅ AI响应完成，包含图片，共 {total_chars} 字符")
+            else:
+                logger.success(f"✅ AI响应完成，共 {total_chars} 字符")
+        finally:
+            await upstream.aclose()
     
+    async def collect(self, upstream: "UpstreamStream", request_data: dict, hasher=None, stats=None, capture=None) -> dict:
+        """
+        非流式模式：读完上游流，返回单个 chat.completion 响应体
+        片段收集到列表后一次 join，不构造任何逐块的 OpenAI 包装
+        """
+        parts = []
+        try:
+            async for content in self._iter_contents(upstream):
+                if stats is not None and not parts:
+                    stats.on_content(0)
+                parts.append(content)
+        finally:
+            await upstream.aclose()
+        
+        content = "".join(parts)
+        if capture is not None:
+            capture.extend(parts)
+        completion_tokens = estimate_tokens(content)
+        if stats is not None:
+            stats.finished_at = time.time()
+            stats.chunks = len(parts)
+            stats.completion_tokens = completion_tokens
+        if hasher is not None:
+            hasher.update(content.encode("utf-8"))
+        logger.success(f"✅ AI响应完成（非流式），共 {len(content)} 字符")
+        return create_chat_completion(
+            f"chatcmpl-{uuid.uuid4()}",
+            upstream.model,
+            content,
+            finish_reason="stop",
+            prompt_tokens=estimate_prompt_tokens(request_data.get("messages", [])),
+            completion_tokens=completion_tokens,
+        )
+
     def _extract_ai_response(self, data):
         """从Zai API响应中提取AI回复"""
         try:
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+账号健康探测 - 后台定期并发验证所有账号的 Token
+
+架构原则：
+- 探测在后台按计划进行，/api/account/status 直接读取内存快照
+- 每轮探测并发执行（并发上限由 Provider 的验证信号量控制）
+- 支持手动强制重新检查
+"""
+
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, Optional
+from loguru import logger
+from app.core.config import settings
+from app.core.db_manager import db_manager
+
+
+class AccountHealth:
+    """单个账号最近一次探测结果"""
+
+    __slots__ = ("token_key", "is_valid", "checked_at", "latency_ms")
+
+    def __init__(self, token_key: str, is_valid: bool, checked_at: str, latency_ms: int):
+        self.token_key = token_key
+        self.is_valid = is_valid
+        self.checked_at = checked_at
+        self.latency_ms = latency_ms
+
+
+class AccountHealthProber:
+    """账号健康探测器"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.interval = settings.HEALTH_CHECK_INTERVAL
+        self.is_running = False
+        self._snapshot: Dict[int, AccountHealth] = {}
+        self._round: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.is_running: return
+        self.is_running = True
+        logger.info("🩺 账号健康探测启动")
+        while self.is_running:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"账号健康探测出错: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        self.is_running = False
+        logger.info("🛑 账号健康探测停止")
+
+    async def check_all(self):
+        """并发探测所有账号；已有一轮在进行时直接等待它，避免重复探测"""
+        if self._round is None or self._round.done():
+            self._round = asyncio.create_task(self._check_round())
+        await asyncio.shield(self._round)
+
+    async def _check_round(self):
+        accounts = [acc for acc in db_manager.get_all_accounts() if acc.get('token')]
+        live_ids = {acc['id'] for acc in accounts}
+        for account_id in list(self._snapshot):
+            if account_id not in live_ids:
+                del self._snapshot[account_id]
+        if not accounts:
+            return
+        started = time.time()
+        await asyncio.gather(*(self._check_one(acc) for acc in accounts))
+        valid = sum(1 for acc in accounts if self.get(acc) and self.get(acc).is_valid)
+        logger.info(f"🩺 探测完成: {valid}/{len(accounts)} 个账号有效，用时 {int((time.time() - started) * 1000)}ms")
+
+    async def _check_one(self, account):
+        start = time.monotonic()
+        try:
+            is_valid = await self.provider.averify_token(account['token'], use_cache=False)
+        except Exception as e:
+            logger.error(f"探测账号 [{account['name']}] 失败: {e}")
+            is_valid = False
+        self._snapshot[account['id']] = AccountHealth(
+            token_key=self.provider.token_key(account['token']),
+            is_valid=is_valid,
+            checked_at=datetime.now().isoformat(),
+            latency_ms=int((time.monotonic() - start) * 1000),
+        )
+
+    def get(self, account) -> Optional[AccountHealth]:
+        """返回账号当前 Token 的探测结果；Token 已更换或尚未探测时返回 None"""
+        health = self._snapshot.get(account['id'])
+        if health is None or not account.get('token'):
+            return None
+        if health.token_key != self.provider.token_key(account['token']):
+            return None
+        return health
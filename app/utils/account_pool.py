@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+账号池 - 内存中的可用账号集合与负载均衡选择
+
+架构原则：
+- 热路径只读内存，不访问 SQLite
+- 账号增删、启停、Token 更新时由 DBManager 回调刷新；回调可能在数据库线程中触发，
+  新的账号列表在事件循环中替换，热路径看到的账号与统计始终一致
+- 选择策略可配置：round_robin / least_inflight / weighted
+- 每个账号有并发上限（非阻塞信号量），达到上限或处于限流冷却中的账号不参与选择
+- 每个账号一个熔断器（closed / open / half-open），按上游错误类别驱动：
+  认证失败（401）立即熔断；403（可能是 Cloudflare 质询）与 5xx、网络错误一样只熔断一段时间，
+  其中 403 不累计次数直接熔断；5xx 与网络错误连续达到阈值后熔断；
+  熔断到期后进入半开状态，只放行一个探测请求，成功即恢复
+"""
+
+import asyncio
+import itertools
+import random
+import time
+from typing import Dict, List, Optional
+from loguru import logger
+from app.core.config import settings
+from app.core.db_manager import db_manager
+
+
+class _AccountStats:
+    """单个账号的运行时统计"""
+
+    __slots__ = ("token", "inflight", "success_score", "cooldown_until",
+                 "breaker", "failures", "open_until", "open_seconds", "probing")
+
+    def __init__(self, token=None):
+        self.token = token  # Token 更换后统计与熔断状态重新开始
+        self.inflight = 0
+        self.success_score = 1.0  # 最近成功率的指数滑动平均，初始视为健康
+        self.cooldown_until = 0.0  # 限流冷却结束时间 (time.monotonic)
+        self.breaker = BREAKER_CLOSED
+        self.failures = 0  # 连续失败次数（5xx / 网络错误）
+        self.open_until = 0.0
+        self.open_seconds = 0.0  # 本次熔断时长，半开探测失败后翻倍
+        self.probing = False  # 半开状态下是否已有探测请求
+
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+# 上游错误类别
+FAILURE_AUTH = "auth"  # 401：Token 失效
+FAILURE_FORBIDDEN = "forbidden"  # 403：可能只是 Cloudflare 质询，不能据此判定 Token 失效
+FAILURE_RATE_LIMIT = "rate_limit"  # 429 或带 Retry-After 的响应
+FAILURE_SERVER = "server"  # 5xx、网络错误、超时
+FAILURE_CLIENT = "client"  # 其余 4xx：请求本身的问题，不计入账号
+
+ACQUIRED_PROBE = "probe"  # acquire() 的返回值（真值）：本次请求是半开状态下的探测请求
+
+
+def _running_in(loop) -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+def classify_failure(error) -> str:
+    """按上游状态码把异常归入错误类别"""
+    status_code = getattr(error, "status_code", None)
+    if status_code == 401:
+        return FAILURE_AUTH
+    if status_code == 403:
+        return FAILURE_FORBIDDEN
+    if status_code == 429 or getattr(error, "retry_after", None) is not None:
+        return FAILURE_RATE_LIMIT
+    if status_code is not None and 400 <= status_code < 500:
+        return FAILURE_CLIENT
+    return FAILURE_SERVER
+
+
+class AccountPool:
+    """账号池 - 单进程内存对象"""
+
+    STRATEGIES = ("round_robin", "least_inflight", "weighted")
+
+    def __init__(self, strategy: str = settings.ACCOUNT_POOL_STRATEGY):
+        if strategy not in self.STRATEGIES:
+            logger.warning(f"⚠️ 未知的账号选择策略 {strategy}，使用 round_robin")
+            strategy = "round_robin"
+        self.strategy = strategy
+        self._accounts: List[dict] = []
+        self._stats: Dict[int, _AccountStats] = {}
+        self._counter = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None  # 热路径所在的事件循环
+        self.reload()
+
+    def reload(self):
+        """从数据库重新加载可用账号（仅在账号变更时调用，可在任意线程调用）"""
+        accounts = db_manager.get_all_accounts(active_only=True)
+        loop = self._loop
+        if loop is not None and not loop.is_closed() and not _running_in(loop):
+            loop.call_soon_threadsafe(self._apply, accounts)
+        else:
+            self._apply(accounts)
+
+    def _apply(self, accounts):
+        self._accounts = accounts
+        # 保留仍存在且 Token 未变账号的统计，丢弃已删除/禁用账号的统计
+        stats = {}
+        for acc in accounts:
+            current = self._stats.get(acc["id"])
+            if current is None or current.token != acc.get("token"):
+                current = _AccountStats(acc.get("token"))
+            stats[acc["id"]] = current
+        self._stats = stats
+        logger.debug(f"🔁 账号池已刷新: {len(accounts)} 个可用账号")
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def _available(self, stats: _AccountStats, now: float) -> bool:
+        if stats.breaker == BREAKER_OPEN:
+            if now < stats.open_until:
+                return False
+            stats.breaker = BREAKER_HALF_OPEN  # 熔断到期，允许一个探测请求
+        if stats.breaker == BREAKER_HALF_OPEN and stats.probing:
+            return False
+        cap = settings.ACCOUNT_MAX_CONCURRENCY
+        return stats.cooldown_until <= now and (cap <= 0 or stats.inflight < cap)
+
+    def candidates(self) -> List[dict]:
+        """
+        按当前策略返回账号尝试顺序（第一个为首选，其余用于故障转移）
+        已达并发上限、处于冷却中或熔断中的账号被跳过
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        accounts = [acc for acc in self._accounts if self._available(self._stats[acc["id"]], now)]
+        if len(accounts) <= 1:
+            return list(accounts)
+
+        if self.strategy == "least_inflight":
+            offset = next(self._counter) % len(accounts)
+            rotated = accounts[offset:] + accounts[:offset]  # 并列时轮转，避免总选同一个
+            return sorted(rotated, key=lambda acc: self._stats[acc["id"]].inflight)
+
+        if self.strategy == "weighted":
+            # 按成功率加权的无放回随机抽样 (Efraimidis-Spirakis)
+            def key(acc):
+                weight = max(self._stats[acc["id"]].success_score, 0.01)
+                return random.random() ** (1.0 / weight)
+            return sorted(accounts, key=key, reverse=True)
+
+        offset = next(self._counter) % len(accounts)
+        return accounts[offset:] + accounts[:offset]
+
+    def state_counts(self) -> Dict[str, int]:
+        """
+        按状态统计池内账号数：idle 空闲、busy 正在处理请求、
+        saturated 已达并发上限、cooling 限流冷却中、open / half_open 熔断中
+        """
+        now = time.monotonic()
+        cap = settings.ACCOUNT_MAX_CONCURRENCY
+        counts = {"idle": 0, "busy": 0, "saturated": 0, "cooling": 0, "open": 0, "half_open": 0}
+        for stats in self._stats.values():
+            if stats.breaker == BREAKER_OPEN and stats.open_until > now:
+                counts["open"] += 1
+            elif stats.breaker != BREAKER_CLOSED:
+                counts["half_open"] += 1
+            elif stats.cooldown_until > now:
+                counts["cooling"] += 1
+            elif cap > 0 and stats.inflight >= cap:
+                counts["saturated"] += 1
+            elif stats.inflight:
+                counts["busy"] += 1
+            else:
+                counts["idle"] += 1
+        return counts
+
+    def capacity(self) -> int:
+        """当前可接收的并发请求总数：未熔断、未冷却账号的并发上限之和"""
+        now = time.monotonic()
+        per_account = settings.ACCOUNT_MAX_CONCURRENCY if settings.ACCOUNT_MAX_CONCURRENCY > 0 else settings.ADMISSION_SLOTS_PER_ACCOUNT
+        usable = sum(
+            1 for stats in self._stats.values()
+            if stats.cooldown_until <= now and not (stats.breaker == BREAKER_OPEN and stats.open_until > now)
+        )
+        return usable * per_account
+
+    def retry_after(self) -> float:
+        """所有账号都不可用时，预计多少秒后会有账号可用（冷却结束；仅因并发已满时返回 1）"""
+        now = time.monotonic()
+        waits = [
+            max(stats.cooldown_until, stats.open_until if stats.breaker == BREAKER_OPEN else 0.0) - now
+            for stats in self._stats.values()
+            if stats.cooldown_until > now or (stats.breaker == BREAKER_OPEN and stats.open_until > now)
+        ]
+        if len(waits) < len(self._stats):
+            return 1.0
+        return min(waits) if waits else 1.0
+
+    def acquire(self, account_id: int):
+        """
+        占用账号的一个并发名额（非阻塞）：已达上限或冷却中时返回 False，
+        调用方应改用下一个候选账号；半开状态下的探测请求返回 ACQUIRED_PROBE，
+        调用方在 release() 时需传回 probe=True
+        """
+        stats = self._stats.get(account_id)
+        if stats is None:
+            return True
+        if not self._available(stats, time.monotonic()):
+            return False
+        stats.inflight += 1
+        if stats.breaker == BREAKER_HALF_OPEN:
+            stats.probing = True
+            logger.info(f"🔌 账号 ID {account_id} 熔断半开，发送探测请求")
+            return ACQUIRED_PROBE
+        return True
+
+    def cooldown(self, account_id: int, seconds: float):
+        """账号被上游限流，在 seconds 秒内不参与选择"""
+        stats = self._stats.get(account_id)
+        if stats is None:
+            return
+        seconds = min(max(seconds, 0.0), settings.RATE_LIMIT_MAX_COOLDOWN)
+        stats.cooldown_until = max(stats.cooldown_until, time.monotonic() + seconds)
+        logger.warning(f"🧊 账号 ID {account_id} 被限流，冷却 {int(seconds)} 秒")
+
+    def release(self, account_id: int, success: Optional[bool], probe: bool = False):
+        """
+        标记账号请求结束，并更新成功率
+        success 为 None 表示结果与账号无关（客户端取消、请求本身无效），不计入成功率与熔断；
+        只有探测请求（probe=True）成功才会关闭熔断，熔断前发出的请求成功不算
+        """
+        stats = self._stats.get(account_id)
+        if stats is None:
+            return
+        stats.inflight = max(stats.inflight - 1, 0)
+        if probe:
+            stats.probing = False  # 探测结束；没有结论时允许下一个探测
+        if success is None:
+            return
+        alpha = settings.ACCOUNT_SUCCESS_DECAY
+        stats.success_score = (1 - alpha) * stats.success_score + alpha * (1.0 if success else 0.0)
+        if success:
+            stats.failures = 0
+            if probe and stats.breaker == BREAKER_HALF_OPEN:
+                logger.success(f"✅ 账号 ID {account_id} 探测成功，熔断恢复")
+                stats.breaker = BREAKER_CLOSED
+                stats.open_seconds = 0.0
+
+    def report_failure(self, account_id: int, error) -> str:
+        """
+        按错误类别更新账号状态（在 release 之后调用），返回错误类别
+        认证失败立即熔断；限流进入冷却；403 直接熔断 BREAKER_OPEN_SECONDS；
+        5xx / 网络错误连续达到阈值后熔断；半开探测失败则重新熔断，时长翻倍
+        """
+        kind = classify_failure(error)
+        stats = self._stats.get(account_id)
+        if stats is None or kind == FAILURE_CLIENT:
+            return kind
+        if kind == FAILURE_RATE_LIMIT:
+            self.cooldown(account_id, getattr(error, "retry_after", None) or settings.RATE_LIMIT_COOLDOWN)
+            return kind
+
+        stats.failures += 1
+        if kind == FAILURE_AUTH:
+            self._open(account_id, stats, settings.BREAKER_AUTH_OPEN_SECONDS, "认证失败")
+        elif stats.breaker == BREAKER_HALF_OPEN:
+            self._open(account_id, stats, min(stats.open_seconds * 2, settings.BREAKER_MAX_OPEN_SECONDS), "探测失败")
+        elif kind == FAILURE_FORBIDDEN:
+            self._open(account_id, stats, settings.BREAKER_OPEN_SECONDS, "上游拒绝访问 (403)")
+        elif stats.breaker == BREAKER_CLOSED and stats.failures >= settings.BREAKER_FAILURE_THRESHOLD:
+            self._open(account_id, stats, settings.BREAKER_OPEN_SECONDS, f"连续失败 {stats.failures} 次")
+        return kind
+
+    def _open(self, account_id: int, stats: _AccountStats, seconds: float, reason: str):
+        stats.breaker = BREAKER_OPEN
+        stats.open_seconds = max(seconds, settings.BREAKER_OPEN_SECONDS)
+        stats.open_until = time.monotonic() + stats.open_seconds
+        stats.probing = False
+        logger.warning(f"⚡ 账号 ID {account_id} 熔断 {int(stats.open_seconds)} 秒: {reason}")
+
+
+account_pool = AccountPool()
+db_manager.add_listener(account_pool.reload)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制 - 在打开上游连接之前限制同时处理的请求数
+
+架构原则：
+- 并发上限随账号池的当前容量变化（可用账号数 × 每账号并发上限）
+- 超出容量的请求进入有界等待队列，分 interactive / batch 两条优先级通道，
+  batch 按固定比例获得放行机会，不会被饿死
+- 同一通道内按 API Key 轮转放行，单个调用方无法占满队列
+- 按平均服务时间估算排队时长，超过通道的等待上限时立即返回 429 + Retry-After，
+  而不是让请求在队列里等到超时
+"""
+
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+from loguru import logger
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.utils.account_pool import account_pool
+
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+LANES = (LANE_INTERACTIVE, LANE_BATCH)
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝（队列已满或预计等待超时）"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """已获准的请求，处理结束时交还 release()"""
+
+    __slots__ = ("lane", "granted_at", "released")
+
+    def __init__(self, lane: str):
+        self.lane = lane
+        self.granted_at = time.monotonic()
+        self.released = False
+
+
+class _Waiter:
+    __slots__ = ("future", "lane", "tenant", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, lane: str, tenant: str):
+        self.future = future
+        self.lane = lane
+        self.tenant = tenant
+        self.enqueued_at = time.monotonic()
+
+
+class _Lane:
+    """一条优先级通道：按调用方分组的 FIFO，调用方之间轮转"""
+
+    def __init__(self):
+        self._tenants: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self.size = 0
+
+    def push(self, waiter: _Waiter):
+        queue = self._tenants.get(waiter.tenant)
+        if queue is None:
+            queue = self._tenants[waiter.tenant] = deque()
+        queue.append(waiter)
+        self.size += 1
+
+    def pop(self) -> _Waiter:
+        tenant, queue = next(iter(self._tenants.items()))
+        waiter = queue.popleft()
+        if queue:
+            self._tenants.move_to_end(tenant)  # 轮到下一个调用方
+        else:
+            del self._tenants[tenant]
+        self.size -= 1
+        return waiter
+
+    def remove(self, waiter: _Waiter):
+        queue = self._tenants.get(waiter.tenant)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._tenants[waiter.tenant]
+        self.size -= 1
+
+
+class AdmissionController:
+    """全局准入控制器 - 单例使用"""
+
+    def __init__(self, pool=account_pool):
+        self.pool = pool
+        self.active = 0
+        self._lanes: Dict[str, _Lane] = {lane: _Lane() for lane in LANES}
+        self._grants = 0
+        self._service_time: Optional[float] = None  # 请求占用时长的指数滑动平均（秒）
+        self._batch_keys = {key.strip() for key in settings.ADMISSION_BATCH_KEYS.split(",") if key.strip()}
+
+    # ==================== 通道与容量 ====================
+
+    def lane_for(self, priority: Optional[str], api_key: Optional[str]) -> str:
+        """请求头 X-Priority 优先；否则按 API Key 是否在 ADMISSION_BATCH_KEYS 中决定"""
+        if priority:
+            priority = priority.strip().lower()
+            if priority in LANES:
+                return priority
+        if api_key and api_key in self._batch_keys:
+            return LANE_BATCH
+        return LANE_INTERACTIVE
+
+    def capacity(self) -> int:
+        return self.pool.capacity()
+
+    def queued(self) -> int:
+        return sum(lane.size for lane in self._lanes.values())
+
+    def _max_wait(self, lane: str) -> float:
+        return settings.ADMISSION_BATCH_MAX_WAIT if lane == LANE_BATCH else settings.ADMISSION_MAX_WAIT
+
+    def _estimate_wait(self, ahead: int, capacity: int) -> float:
+        if self._service_time is None or capacity <= 0:
+            return 0.0
+        return (ahead + 1) / capacity * self._service_time
+
+    # ==================== 获取与释放 ====================
+
+    async def acquire(self, lane: str, tenant: str) -> AdmissionTicket:
+        """获取处理名额；需要排队时等待，无法在等待上限内获得时抛出 AdmissionRejected"""
+        capacity = self.capacity()
+        if capacity <= 0 or (self.active < capacity and not self.queued()):
+            # 没有可用账号时直接放行，由后续逻辑返回 429/503
+            return self._grant(lane)
+
+        ahead = self._lanes[LANE_INTERACTIVE].size + (self._lanes[LANE_BATCH].size if lane == LANE_BATCH else 0)
+        if self.queued() >= max(int(capacity * settings.ADMISSION_QUEUE_FACTOR), 1):
+            self._reject(lane, "queue_full")
+            raise AdmissionRejected("请求队列已满", self._estimate_wait(ahead, capacity) or 1.0)
+        estimate = self._estimate_wait(ahead, capacity)
+        max_wait = self._max_wait(lane)
+        if estimate > max_wait:
+            self._reject(lane, "deadline")
+            raise AdmissionRejected("预计排队时间过长", estimate)
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), lane, tenant)
+        self._lanes[lane].push(waiter)
+        metrics.admission_queued.inc(lane)
+        try:
+            await asyncio.wait((waiter.future,), timeout=max_wait)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        if not waiter.future.done():
+            self._abandon(waiter)
+            self._reject(lane, "timeout")
+            raise AdmissionRejected("排队超时", self._estimate_wait(ahead, capacity) or max_wait)
+        metrics.admission_wait.observe(time.monotonic() - waiter.enqueued_at, lane)
+        return waiter.future.result()
+
+    def release(self, ticket: Optional[AdmissionTicket]):
+        """交还名额（可重复调用）"""
+        if ticket is None or ticket.released:
+            return
+        ticket.released = True
+        self.active = max(self.active - 1, 0)
+        held = time.monotonic() - ticket.granted_at
+        alpha = settings.ADMISSION_SERVICE_DECAY
+        self._service_time = held if self._service_time is None else (1 - alpha) * self._service_time + alpha * held
+        self._dispatch()
+
+    def _grant(self, lane: str) -> AdmissionTicket:
+        self.active += 1
+        self._grants += 1
+        return AdmissionTicket(lane)
+
+    def _dispatch(self):
+        """在容量允许的范围内按优先级放行排队的请求"""
+        capacity = self.capacity()
+        while self.queued() and (self.active < capacity or capacity <= 0):
+            interactive, batch = self._lanes[LANE_INTERACTIVE], self._lanes[LANE_BATCH]
+            share = max(settings.ADMISSION_BATCH_SHARE, 1)
+            if batch.size and (not interactive.size or self._grants % share == share - 1):
+                lane = batch
+            else:
+                lane = interactive
+            waiter = lane.pop()
+            metrics.admission_queued.dec(waiter.lane)
+            if waiter.future.done():
+                continue
+            waiter.future.set_result(self._grant(waiter.lane))
+
+    def _abandon(self, waiter: _Waiter):
+        """等待者放弃排队（超时或调用方取消）；已获准则交还名额"""
+        if waiter.future.done() and not waiter.future.cancelled():
+            self.release(waiter.future.result())
+            return
+        waiter.future.cancel()
+        before = self._lanes[waiter.lane].size
+        self._lanes[waiter.lane].remove(waiter)
+        if self._lanes[waiter.lane].size < before:
+            metrics.admission_queued.dec(waiter.lane)
+
+    def _reject(self, lane: str, reason: str):
+        metrics.admission_rejected.inc(lane, reason)
+        logger.warning(f"🚦 拒绝请求 ({lane}, {reason}): 处理中 {self.active}/{self.capacity()}，排队 {self.queued()}")
+
+    @staticmethod
+    def retry_after_header(seconds: float) -> str:
+        return str(max(int(math.ceil(seconds)), 1))
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "capacity": self.capacity(),
+            "queued_interactive": self._lanes[LANE_INTERACTIVE].size,
+            "queued_batch": self._lanes[LANE_BATCH].size,
+        }
+
+
+admission_controller = AdmissionController()
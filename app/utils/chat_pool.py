@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+预创建对话池 - 为每个账号、每个模型预先创建空对话
+
+架构原则：
+- 请求路径直接取出现成的 chat_id，省去 POST /api/v1/chats/new 这一轮往返
+- 后台补货任务按各 (账号, 模型) 最近的请求速率调整库存，没有流量的组合不备货
+- 账号失效或 Token 更换后，其库存直接丢弃
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+from loguru import logger
+from app.core.config import settings
+from app.core.db_manager import db_manager
+
+
+class _Stock:
+    """单个 (账号, 模型) 的库存与请求速率"""
+
+    __slots__ = ("token_key", "chats", "rate", "last_request", "creating")
+
+    def __init__(self, token_key: str):
+        self.token_key = token_key
+        self.chats: Deque[Tuple[str, float]] = deque()  # (chat_id, 创建时间)
+        self.rate = 0.0  # 请求速率的指数滑动估计（次/秒）
+        self.last_request = 0.0
+        self.creating = 0
+
+    def record_request(self, now: float):
+        if self.last_request:
+            interval = max(now - self.last_request, 1e-3)
+            alpha = settings.CHAT_POOL_RATE_DECAY
+            self.rate = (1 - alpha) * self.rate + alpha / interval
+        else:
+            self.rate = 1.0 / settings.CHAT_POOL_HORIZON  # 首次请求：至少备 1 个
+        self.last_request = now
+
+    def target(self, now: float) -> int:
+        # 长时间没有请求时速率按空闲时长衰减，库存随之归零
+        idle = now - self.last_request
+        rate = min(self.rate, 1.0 / idle) if idle > 0 else self.rate
+        return min(settings.CHAT_POOL_MAX, int(rate * settings.CHAT_POOL_HORIZON + 0.5))
+
+
+class ChatPool:
+    """预创建对话池"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.is_running = False
+        self._stocks: Dict[Tuple[int, str], _Stock] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self):
+        if self.is_running or not settings.CHAT_POOL_ENABLED: return
+        self.is_running = True
+        self._wakeup = asyncio.Event()
+        logger.info("🧺 预创建对话池启动")
+        while self.is_running:
+            try:
+                self._replenish()
+            except Exception as e:
+                logger.error(f"对话池补货出错: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.CHAT_POOL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def stop(self):
+        self.is_running = False
+        if self._wakeup is not None:
+            self._wakeup.set()
+        logger.info("🛑 预创建对话池停止")
+
+    def take(self, account, model: str) -> Optional[str]:
+        """取出一个可用的预创建对话；没有库存时返回 None（调用方自行创建）"""
+        if not self.is_running:
+            return None
+        now = time.time()
+        token_key = self.provider.token_key(account['token'])
+        key = (account['id'], model)
+        stock = self._stocks.get(key)
+        if stock is None or stock.token_key != token_key:
+            stock = self._stocks[key] = _Stock(token_key)
+        stock.record_request(now)
+
+        chat_id = None
+        while stock.chats:
+            candidate, created = stock.chats.popleft()
+            if now - created <= settings.CHAT_POOL_MAX_AGE:
+                chat_id = candidate
+                break
+        if chat_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._wakeup.set()  # 取走后立即补货
+        return chat_id
+
+    def _replenish(self):
+        now = time.time()
+        accounts = {acc['id']: acc for acc in db_manager.get_all_accounts(active_only=True)}
+        for key, stock in list(self._stocks.items()):
+            account = accounts.get(key[0])
+            if account is None or not account.get('token') or self.provider.token_key(account['token']) != stock.token_key:
+                del self._stocks[key]  # 账号已禁用/删除或 Token 已更换
+                continue
+            while stock.chats and now - stock.chats[0][1] > settings.CHAT_POOL_MAX_AGE:
+                stock.chats.popleft()
+            missing = stock.target(now) - len(stock.chats) - stock.creating
+            for _ in range(max(missing, 0)):
+                stock.creating += 1
+                asyncio.create_task(self._create(stock, account['token'], key[1]))
+
+    async def _create(self, stock: _Stock, token: str, model: str):
+        try:
+            chat_id = await self.provider.create_empty_chat(token, model)
+            if chat_id:
+                stock.chats.append((chat_id, time.time()))
+        except Exception as e:
+            logger.warning(f"预创建对话失败 ({model}): {e}")
+        finally:
+            stock.creating -= 1
+
+    def stats(self):
+        return {
+            "stocked": sum(len(stock.chats) for stock in self._stocks.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,32 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional
+
+def decode_jwt_payload(token: str) -> Optional[dict]:
+    """
+    解码 JWT 的 payload 部分（不校验签名，只用于读取 exp 等声明）。
+    不是合法 JWT 时返回 None。
+    """
+    if not token or token.count('.') != 2:
+        return None
+    payload = token.split('.')[1]
+    try:
+        padded = payload + '=' * (-len(payload) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+    return data if isinstance(data, dict) else None
+
+def get_token_expiry(token: str) -> Optional[datetime]:
+    """读取 Token 的 exp 声明并转为本地时间；没有 exp 时返回 None"""
+    payload = decode_jwt_payload(token)
+    if not payload:
+        return None
+    exp = payload.get('exp')
+    if not isinstance(exp, (int, float)):
+        return None
+    try:
+        return datetime.fromtimestamp(exp)
+    except (OverflowError, OSError, ValueError):
+        return None
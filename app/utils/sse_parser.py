@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+增量 SSE 解码器 - 直接处理 aiter_bytes() 产出的字节块
+
+架构原则：
+- 按 SSE 规范解析：CR / LF / CRLF 均为行结束，空行派发事件，
+  多行 data 以换行拼接，支持 event / id 字段与 ":" 注释行
+- 字节块可以在任意位置断开（包括行中间、CRLF 中间、多字节字符中间），
+  不完整的行留在缓冲区等待下一块
+- data 以 bytes 累积，派发时才整体解码一次
+"""
+
+from typing import List, Optional
+
+
+class SSEEvent:
+    """一个已派发的 SSE 事件"""
+
+    __slots__ = ("event", "data", "id")
+
+    def __init__(self, event: str, data: str, id: str):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data[:80]!r}, id={self.id!r})"
+
+
+class SSEDecoder:
+    """增量 SSE 解码器（每个流一个实例）"""
+
+    __slots__ = ("_buffer", "_skip_lf", "_data", "_event", "_last_id", "retry")
+
+    def __init__(self):
+        self._buffer = b""
+        self._skip_lf = False  # 上一块以 CR 结尾时，下一块开头的 LF 属于同一个行结束
+        self._data: List[bytes] = []
+        self._event = ""
+        self._last_id = ""
+        self.retry: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """输入一个字节块，返回其中完成的事件"""
+        if self._skip_lf:
+            self._skip_lf = False
+            if chunk[:1] == b"\n":
+                chunk = chunk[1:]
+        data = self._buffer + chunk if self._buffer else chunk
+        if not data:
+            return []
+
+        lines = data.splitlines(keepends=True)
+        last = lines[-1]
+        if last[-1:] not in (b"\n", b"\r"):
+            self._buffer = lines.pop()  # 行未结束，留到下一块
+        else:
+            self._buffer = b""
+            if last[-1:] == b"\r":
+                self._skip_lf = True
+
+        events = []
+        for line in lines:
+            event = self._process_line(line.rstrip(b"\r\n"))
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self) -> List[SSEEvent]:
+        """
+        流结束时调用，返回缓冲区中剩余的事件
+        规范要求丢弃没有以空行结尾的事件，这里为兼容不规范的上游仍然派发
+        """
+        events = []
+        if self._buffer:
+            line, self._buffer = self._buffer, b""
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line[:1] == b":":
+            return None  # 注释
+
+        field, sep, value = line.partition(b":")
+        if sep and value[:1] == b" ":
+            value = value[1:]
+
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8", "replace")
+        elif field == b"id":
+            if b"\0" not in value:
+                self._last_id = value.decode("utf-8", "replace")
+        elif field == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+        # 其余字段按规范忽略
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        data, event = self._data, self._event
+        self._data = []
+        self._event = ""
+        if not data:
+            return None
+        payload = data[0] if len(data) == 1 else b"\n".join(data)
+        return SSEEvent(event or "message", payload.decode("utf-8", "replace"), self._last_id)
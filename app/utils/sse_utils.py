@@ -1,6 +1,22 @@
 import json
 import time
 
+try:
+    import orjson  # 可选：更快的 JSON 后端
+except ImportError:
+    orjson = None
+
+
+# 解析上游事件用：orjson 可用时更快，解析失败同样抛出 ValueError
+loads_json = orjson.loads if orjson is not None else json.loads
+
+
+def _dumps_text(text: str) -> bytes:
+    """把字符串序列化为 JSON 字符串字面量（含引号）"""
+    if orjson is not None:
+        return orjson.dumps(text)
+    return json.dumps(text, ensure_ascii=False).encode("utf-8")
+
 def create_chat_completion_chunk(request_id, model, content, finish_reason=None):
     return {
         "id": request_id,
@@ -12,4 +28,69 @@ def create_chat_completion_chunk(request_id, model, content, finish_reason=None)
             "delta": {"content": content} if content else {},
             "finish_reason": finish_reason
         }]
-    }
\ No newline at end of file
+    }
+
+class ChunkEncoder:
+    """
+    流式 chat.completion.chunk 编码器（每个请求一个）
+    信封中 id/object/created/model 等固定部分在构造时渲染一次，
+    每个增量只转义 content 本身，直接产出 bytes
+    """
+
+    __slots__ = ("_prefix", "_suffix", "_head")
+
+    def __init__(self, request_id, model, created=None):
+        envelope = {
+            "id": request_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()) if created is None else created,
+            "model": model,
+        }
+        # 去掉末尾的 "}"，后面接 choices
+        self._head = b"data: " + json.dumps(envelope, separators=(",", ":")).encode("utf-8")[:-1]
+        self._prefix = self._head + b',"choices":[{"index":0,"delta":{"content":'
+        self._suffix = b'},"finish_reason":null}]}\n\n'
+
+    def encode(self, content: str) -> bytes:
+        return self._prefix + _dumps_text(content) + self._suffix
+
+    def finish(self, finish_reason="stop") -> bytes:
+        """结束块 + [DONE] 标记"""
+        return (
+            self._head
+            + b',"choices":[{"index":0,"delta":{},"finish_reason":'
+            + _dumps_text(finish_reason)
+            + b'}]}\n\ndata: [DONE]\n\n'
+        )
+
+def create_chat_completion(request_id, model, content, finish_reason="stop", prompt_tokens=0, completion_tokens=0):
+    return {
+        "id": request_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+def estimate_tokens(text):
+    """粗略估算 token 数：ASCII 约 4 字符 1 个 token，其余（中日韩等）约 1 字符 1 个 token"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def estimate_prompt_tokens(messages):
+    """粗略估算消息历史的 token 数（多模态内容按 JSON 计）"""
+    return estimate_tokens("".join(
+        msg["content"] if isinstance(msg.get("content"), str) else json.dumps(msg.get("content"), ensure_ascii=False)
+        for msg in messages
+    ))
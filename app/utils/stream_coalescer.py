@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式增量合并 - 位于上游解析与 SSE 编码之间
+
+架构原则：
+- 首个片段立即发送，不影响首字延迟
+- 之后的片段在窗口内累积，窗口到期或缓冲达到字节上限时合并为一个片段发送
+- 上游结束时立即发送剩余内容；上游出错时先发送已缓冲的内容再抛出
+- 等待上游的任务在窗口到期时不会被取消，下一个窗口继续等待同一个任务
+"""
+
+import asyncio
+from typing import AsyncIterator
+
+
+async def coalesce_deltas(contents: AsyncIterator[str], window: float, max_bytes: int) -> AsyncIterator[str]:
+    """把 contents 产出的内容片段按时间窗口（秒）与字节上限合并"""
+    loop = asyncio.get_running_loop()
+    source = contents.__aiter__()
+    buffer = []
+    size = 0
+    deadline = 0.0
+    first = True
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(source.__anext__())
+            if buffer:
+                timeout = deadline - loop.time()
+                if timeout <= 0 or not (await asyncio.wait((pending,), timeout=timeout))[0]:
+                    # 窗口到期：发送已缓冲内容，继续等待同一个任务
+                    yield "".join(buffer)
+                    buffer, size = [], 0
+                    continue
+            else:
+                await asyncio.wait((pending,))
+
+            task, pending = pending, None
+            try:
+                content = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if buffer:
+                    yield "".join(buffer)
+                    buffer = []
+                raise
+
+            if first:
+                first = False
+                yield content
+                continue
+            if not buffer:
+                deadline = loop.time() + window
+            buffer.append(content)
+            size += len(content.encode("utf-8"))
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer, size = [], 0
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            await aclose()
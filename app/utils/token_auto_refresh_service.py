@@ -1,33 +1,103 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
+import heapq
 import os
+import random
+import time
 from datetime import datetime, timedelta
+from typing import Dict, Optional
 from loguru import logger
 from playwright.async_api import async_playwright
 from app.core.config import settings
 from app.core.db_manager import db_manager
+from app.core.metrics import metrics
+from app.utils.jwt_utils import get_token_expiry
+
+
+def _driver_lost(error) -> bool:
+    """Playwright 驱动进程退出后，所有调用都会报连接已关闭"""
+    return "connection closed" in str(error).lower()
 
 class TokenAutoRefreshService:
     def __init__(self):
         self.is_running = False
-        self.refresh_interval = 3600
+        self.refresh_interval = 3600  # 调度器最长休眠时间（兜底）
         self.preview_mode = False
-        self.token_valid_duration = 10800
-        self.refresh_threshold = 3600
+        # 按截止时间排序的刷新计划: (计划刷新时间戳, 账号ID)，账号变更时重建
+        self._schedule = []
+        self._schedule_dirty = True
+        self._retry_at: Dict[int, float] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop = None
+        self._listening = False
+        # 进程内唯一的 Playwright 运行时，首次使用时启动
+        self._playwright = None
+        self._playwright_lock: Optional[asyncio.Lock] = None
+        # 刷新并发槽位（限制同时运行的 Chromium 数量）与进行中的刷新任务（同账号合并）
+        self._refresh_slots: Optional[asyncio.Semaphore] = None
+        self._refreshing: Dict[int, asyncio.Task] = {}
         
     async def start(self):
         if self.is_running: return
         self.is_running = True
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._schedule_dirty = True
+        if not self._listening:
+            db_manager.add_listener(self._on_accounts_changed)
+            self._listening = True
         logger.info("🔄 自动刷新服务启动")
         while self.is_running:
-            await self.check_and_refresh_tokens()
-            await asyncio.sleep(self.refresh_interval)
+            if self._schedule_dirty:
+                self._rebuild_schedule()
+            self._dispatch_due()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._seconds_until_next())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
     
     def stop(self):
         self.is_running = False
+        if self._wakeup is not None:
+            self._wakeup.set()
         logger.info("🛑 自动刷新服务停止")
     
+    async def close(self):
+        """停止 Playwright 运行时（进程退出时调用）"""
+        for task in list(self._refreshing.values()):
+            task.cancel()
+        if self._playwright is not None:
+            try:
+                await self._playwright.stop()
+            except Exception as e:
+                logger.error(f"停止 Playwright 失败: {e}")
+            self._playwright = None
+            logger.info("🔒 Playwright 运行时已停止")
+    
+    async def _get_playwright(self):
+        """获取长期存活的 Playwright 运行时，避免每次刷新都重新启动驱动"""
+        if self._playwright is None:
+            if self._playwright_lock is None:
+                self._playwright_lock = asyncio.Lock()
+            async with self._playwright_lock:
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
+                    logger.info("🎭 Playwright 运行时已启动")
+        return self._playwright
+    
+    async def _discard_playwright(self, runtime):
+        """启动浏览器失败或与驱动的连接断开时丢弃运行时，下次调用 _get_playwright 重新创建"""
+        if runtime is None or self._playwright is not runtime:
+            return  # 已被其他刷新丢弃并重建
+        self._playwright = None
+        try:
+            await runtime.stop()
+        except Exception as e:
+            logger.debug(f"停止失效的 Playwright 运行时失败: {e}")
+        logger.warning("🎭 Playwright 运行时异常，已丢弃，下次使用时重新启动")
+    
     def set_preview_mode(self, enabled: bool):
         self.preview_mode = enabled
         logger.info(f"👁️ 预览模式: {enabled}")
@@ -46,115 +116,220 @@ class TokenAutoRefreshService:
         browser = None
         context = None
         token = None
+        p = None
         
         try:
-            async with async_playwright() as p:
-                # 使用 launch_persistent_context 启动有头浏览器
+            p = await self._get_playwright()
+            # 使用 launch_persistent_context 启动有头浏览器
+            try:
                 context = await p.chromium.launch_persistent_context(
                     user_data_dir=browser_data_dir,
                     headless=False,
                     args=["--disable-blink-features=AutomationControlled"]
                 )
-                page = await context.new_page()
-                
-                await page.goto("https://zai.is/", wait_until="networkidle")
-                logger.info("⏳ 浏览器已打开 zai.is，等待用户登录...")
-                logger.info("📝 提示：请在浏览器中完成 Discord 登录，登录成功后会自动检测到 Token")
-                
-                # 循环检测 Token (5分钟超时)
-                for i in range(300):
-                    try:
-                        # 获取当前URL，判断登录进度
-                        current_url = page.url
-                        logger.debug(f"[{i+1}/300] 当前URL: {current_url}")
-                        
-                        # 尝试获取Token
-                        token = await page.evaluate("() => localStorage.getItem('token')")
-                        
-                        if token and len(token) > 50:
-                            logger.success(f"✅ 成功捕获到 Token！长度: {len(token)}")
-                            logger.info(f"🔑 Token 预览: {token[:20]}...{token[-10:]}")
-                            
-                            # 尝试获取 Discord cookies（如果有）
-                            try:
-                                cookies = await context.cookies()
-                                discord_cookies = [c for c in cookies if 'discord' in c.get('domain', '')]
-                                if discord_cookies:
-                                    logger.info(f"🍪 检测到 {len(discord_cookies)} 个 Discord Cookie")
-                                    for cookie in discord_cookies[:3]:  # 只显示前3个
-                                        logger.debug(f"   - {cookie['name']}: {cookie['value'][:20]}...")
-                            except Exception as e:
-                                logger.debug(f"获取Cookie失败: {e}")
-                            
-                            await asyncio.sleep(2)  # 等待数据写入磁盘
-                            break
+            except Exception:
+                await self._discard_playwright(p)
+                raise
+            page = await context.new_page()
+            
+            await page.goto("https://zai.is/", wait_until="networkidle")
+            logger.info("⏳ 浏览器已打开 zai.is，等待用户登录...")
+            logger.info("📝 提示：请在浏览器中完成 Discord 登录，登录成功后会自动检测到 Token")
+            
+            # 循环检测 Token (5分钟超时)
+            for i in range(300):
+                try:
+                    # 获取当前URL，判断登录进度
+                    current_url = page.url
+                    logger.debug(f"[{i+1}/300] 当前URL: {current_url}")
+                    
+                    # 尝试获取Token
+                    token = await page.evaluate("() => localStorage.getItem('token')")
+                    
+                    if token and len(token) > 50:
+                        logger.success(f"✅ 成功捕获到 Token！长度: {len(token)}")
+                        logger.info(f"🔑 Token 预览: {token[:20]}...{token[-10:]}")
                         
-                        # 每10秒输出一次进度
-                        if i > 0 and i % 10 == 0:
-                            logger.info(f"⏰ 已等待 {i} 秒，请继续在浏览器中完成登录...")
+                        # 尝试获取 Discord cookies（如果有）
+                        try:
+                            cookies = await context.cookies()
+                            discord_cookies = [c for c in cookies if 'discord' in c.get('domain', '')]
+                            if discord_cookies:
+                                logger.info(f"🍪 检测到 {len(discord_cookies)} 个 Discord Cookie")
+                                for cookie in discord_cookies[:3]:  # 只显示前3个
+                                    logger.debug(f"   - {cookie['name']}: {cookie['value'][:20]}...")
+                        except Exception as e:
+                            logger.debug(f"获取Cookie失败: {e}")
                         
-                    except Exception as e:
-                        logger.debug(f"检测异常: {e}")
+                        await asyncio.sleep(2)  # 等待数据写入磁盘
+                        break
                     
-                    await asyncio.sleep(1)
+                    # 每10秒输出一次进度
+                    if i > 0 and i % 10 == 0:
+                        logger.info(f"⏰ 已等待 {i} 秒，请继续在浏览器中完成登录...")
+                    
+                except Exception as e:
+                    logger.debug(f"检测异常: {e}")
                 
-                await context.close()
-                logger.info("🔒 浏览器已关闭")
+                await asyncio.sleep(1)
+            
+            await context.close()
+            logger.info("🔒 浏览器已关闭")
+            
+            if token:
+                # 尝试获取 Discord 用户名
+                discord_username = None
+                try:
+                    discord_username = await page.evaluate("""
+                        () => {
+                            const user = document.querySelector('[class*="username"]');
+                            return user ? user.textContent : null;
+                        }
+                    """)
+                except:
+                    pass
                 
-                if token:
-                    # 尝试获取 Discord 用户名
-                    discord_username = None
-                    try:
-                        discord_username = await page.evaluate("""
-                            () => {
-                                const user = document.querySelector('[class*="username"]');
-                                return user ? user.textContent : null;
-                            }
-                        """)
-                    except:
-                        pass
-                    
-                    logger.info(f"📊 账号信息: Token长度={len(token)}, Discord用户={discord_username or '未获取'}")
-                    
-                    # 存入数据库
-                    account_id = db_manager.create_account(
-                        name=account_name,
-                        token=token,
-                        data_dir=dir_name,
-                        token_source='browser',
-                        discord_username=discord_username or ''
-                    )
-                    
-                    if account_id:
-                        logger.success(f"✅ 账号 [{account_name}] 已保存到数据库 (ID: {account_id})")
-                        return {"success": True, "message": f"登录成功！账号已保存 (ID: {account_id})", "account_id": account_id}
-                    else:
-                        logger.error("❌ 数据库保存失败")
-                        return {"success": False, "message": "Token已获取但数据库保存失败"}
+                logger.info(f"📊 账号信息: Token长度={len(token)}, Discord用户={discord_username or '未获取'}")
+                
+                # 存入数据库
+                account_id = await db_manager.acreate_account(
+                    name=account_name,
+                    token=token,
+                    data_dir=dir_name,
+                    token_source='browser',
+                    discord_username=discord_username or ''
+                )
+                
+                if account_id:
+                    logger.success(f"✅ 账号 [{account_name}] 已保存到数据库 (ID: {account_id})")
+                    return {"success": True, "message": f"登录成功！账号已保存 (ID: {account_id})", "account_id": account_id}
                 else:
-                    return {"success": False, "message": "登录超时或未获取到 Token"}
-                    
+                    logger.error("❌ 数据库保存失败")
+                    return {"success": False, "message": "Token已获取但数据库保存失败"}
+            else:
+                return {"success": False, "message": "登录超时或未获取到 Token"}
+                
         except Exception as e:
             logger.error(f"浏览器登录出错: {e}")
+            if _driver_lost(e):
+                await self._discard_playwright(p)
+            # 运行时是共享的，出错时必须自行关闭浏览器
+            if context is not None:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
             return {"success": False, "message": f"浏览器启动失败: {str(e)}"}
 
-    # --- 核心功能：刷新已有账号 ---
-    async def check_and_refresh_tokens(self):
-        accounts = db_manager.get_all_accounts(active_only=True)
-        for acc in accounts:
-            if acc['token_source'] != 'browser': continue
-            if not acc.get('expires_at'): continue
-            
+    # --- 核心功能：按 Token 过期时间调度刷新 ---
+    def _on_accounts_changed(self):
+        """账号变更回调（可能在数据库线程中触发），标记计划需要重建并唤醒调度器"""
+        self._schedule_dirty = True
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+    
+    def _refresh_due(self, account) -> Optional[float]:
+        """
+        计算账号的计划刷新时间戳
+        过期时间优先取 JWT 的 exp，其次是数据库中的 expires_at；
+        提前 TOKEN_REFRESH_LEAD 秒，再减去按 Token 固定的随机抖动，避免同时创建的账号同时刷新
+        """
+        expiry = get_token_expiry(account['token']) if account.get('token') else None
+        if expiry is None and account.get('expires_at'):
             try:
-                exp = datetime.fromisoformat(acc['expires_at'])
-                if (exp - datetime.now()).total_seconds() < self.refresh_threshold:
-                    logger.info(f"⏳ 账号 {acc['name']} 即将过期，自动刷新...")
-                    await self.refresh_token_now(acc['id'])
-            except Exception as e:
-                logger.error(f"检查账号 {acc['name']} 出错: {e}")
+                expiry = datetime.fromisoformat(account['expires_at'])
+            except ValueError:
+                pass
+        if expiry is None:
+            return None
+        jitter = random.Random(account['token'] or account['id']).uniform(0, settings.TOKEN_REFRESH_JITTER)
+        due = expiry.timestamp() - settings.TOKEN_REFRESH_LEAD - jitter
+        return max(due, self._retry_at.get(account['id'], 0))
+    
+    def _rebuild_schedule(self):
+        schedule = []
+        for acc in db_manager.get_accounts_by_source('browser'):
+            if acc['id'] in self._refreshing:
+                continue  # 刷新任务结束时会再次标记重建
+            due = self._refresh_due(acc)
+            if due is not None:
+                schedule.append((due, acc['id']))
+        heapq.heapify(schedule)
+        self._schedule = schedule
+        self._schedule_dirty = False
+        if schedule:
+            next_at = datetime.fromtimestamp(schedule[0][0]).strftime('%H:%M:%S')
+            logger.debug(f"🗓️ 刷新计划已更新: {len(schedule)} 个账号，最早 {next_at}")
+    
+    def _dispatch_due(self):
+        """启动所有已到期的刷新（并发数由刷新槽位限制）"""
+        now = time.time()
+        while self._schedule and self._schedule[0][0] <= now:
+            _, account_id = heapq.heappop(self._schedule)
+            asyncio.create_task(self._scheduled_refresh(account_id))
+    
+    def _seconds_until_next(self) -> float:
+        if not self._schedule:
+            return self.refresh_interval
+        return min(max(self._schedule[0][0] - time.time(), 0), self.refresh_interval)
+    
+    async def _scheduled_refresh(self, account_id: int):
+        account = db_manager.get_account_by_id(account_id)
+        if account:
+            logger.info(f"⏳ 账号 {account['name']} 即将过期，自动刷新...")
+        # 先按失败登记重试时间：刷新期间或刚结束时重建计划也不会立即再次启动浏览器
+        self._retry_at[account_id] = time.time() + settings.TOKEN_REFRESH_RETRY_DELAY
+        try:
+            success = await self.refresh_token_now(account_id)
+        except Exception as e:
+            logger.error(f"自动刷新账号 ID {account_id} 出错: {e}")
+            success = False
+        if success:
+            # 拿到的新 Token 仍在提前刷新窗口内时按失败处理，等待重试间隔
+            account = db_manager.get_account_by_id(account_id)
+            self._retry_at.pop(account_id, None)
+            due = self._refresh_due(account) if account else None
+            if due is not None and due <= time.time():
+                logger.warning(f"⚠️ 账号 {account['name']} 刷新后的 Token 仍即将过期，{settings.TOKEN_REFRESH_RETRY_DELAY:.0f} 秒后重试")
+                self._retry_at[account_id] = time.time() + settings.TOKEN_REFRESH_RETRY_DELAY
+        self._on_accounts_changed()
 
     async def refresh_token_now(self, account_id: int):
-        account = db_manager.get_account_by_id(account_id)
+        """
+        刷新指定账号的 Token
+        同一账号的并发刷新请求合并为一次，避免两个浏览器同时打开同一个 browser_data
+        """
+        task = self._refreshing.get(account_id)
+        if task is None:
+            task = asyncio.create_task(self._refresh_with_slot(account_id))
+            self._refreshing[account_id] = task
+            task.add_done_callback(lambda _: self._on_refresh_done(account_id))
+        else:
+            logger.debug(f"账号 ID {account_id} 已在刷新中，合并请求")
+        return await asyncio.shield(task)
+    
+    def _on_refresh_done(self, account_id: int):
+        """刷新任务结束：重建期间被跳过的账号需要重新加入计划"""
+        self._refreshing.pop(account_id, None)
+        self._on_accounts_changed()
+    
+    async def _refresh_with_slot(self, account_id: int):
+        """占用一个刷新槽位后执行刷新，槽位数由 REFRESH_CONCURRENCY 决定"""
+        if self._refresh_slots is None:
+            self._refresh_slots = asyncio.Semaphore(settings.REFRESH_CONCURRENCY)
+        async with self._refresh_slots:
+            started = time.monotonic()
+            outcome = "error"
+            try:
+                success = await self._refresh_token(account_id)
+                outcome = "success" if success else "failure"
+                return success
+            finally:
+                metrics.refreshes.inc(outcome)
+                metrics.refresh_duration.observe(time.monotonic() - started, outcome)
+    
+    async def _refresh_token(self, account_id: int):
+        account = await db_manager.aget_account_by_id(account_id)
         if not account or not account.get('data_dir'): return False
         
         data_dir = os.path.join(settings.ACCOUNTS_DATA_DIR, account['data_dir'], "browser_data")
@@ -163,30 +338,40 @@ class TokenAutoRefreshService:
             return False
 
         logger.info(f"🌐 刷新 Token: {account['name']}")
+        p = None
         try:
-            async with async_playwright() as p:
+            p = await self._get_playwright()
+            try:
                 context = await p.chromium.launch_persistent_context(
                     user_data_dir=data_dir,
                     headless=not self.preview_mode,
                     args=["--disable-blink-features=AutomationControlled"]
                 )
-                page = await context.new_page()
-                try:
-                    await page.goto("https://zai.is/", timeout=60000, wait_until="domcontentloaded")
-                    token = None
-                    for _ in range(10):
-                        token = await page.evaluate("() => localStorage.getItem('token')")
-                        if token: break
-                        await asyncio.sleep(1)
-                    
-                    if token:
-                        db_manager.update_token(account_id, token)
-                        logger.success(f"✅ 刷新成功: {account['name']}")
-                        return True
-                finally:
-                    await context.close()
+            except Exception:
+                await self._discard_playwright(p)
+                raise
+            page = await context.new_page()
+            try:
+                await page.goto("https://zai.is/", timeout=60000, wait_until="domcontentloaded")
+                token = None
+                for _ in range(10):
+                    token = await page.evaluate("() => localStorage.getItem('token')")
+                    if token: break
+                    await asyncio.sleep(1)
+                
+                if token == account['token']:
+                    logger.warning(f"⚠️ 刷新未获得新 Token: {account['name']}")
+                    return False
+                if token:
+                    await db_manager.aupdate_token(account_id, token)
+                    logger.success(f"✅ 刷新成功: {account['name']}")
+                    return True
+            finally:
+                await context.close()
         except Exception as e:
             logger.error(f"刷新失败: {e}")
+            if _driver_lost(e):
+                await self._discard_playwright(p)
             return False
         return False
 
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSE 编码微基准 - 对比逐块构造 dict + json.dumps 与 ChunkEncoder 的单块开销
+
+用法（在项目根目录）：
+    python benchmarks/bench_sse_encoder.py [块数]
+
+同时测量 relay() 的完整热路径：上游 SSE 字节解码 + 编码，不含网络 I/O
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger
+from app.utils import sse_utils
+from app.utils.sse_utils import ChunkEncoder, create_chat_completion_chunk
+
+SAMPLES = ["Hello", "，这是一个", " streaming delta with \"quotes\"\n", "中文内容片段" * 4, "x" * 120]
+
+
+def legacy_chunk(request_id, model, content):
+    """旧实现：每块构造 dict、time.time()、两次调试用 dumps、一次 dumps，产出 str 再由框架编码"""
+    chunk = create_chat_completion_chunk(request_id, model, content)
+    json.dumps(chunk, ensure_ascii=False)[:200]  # 原先关闭 debug 时也会执行的调试序列化
+    return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+def bench_encode(n):
+    request_id, model = "chatcmpl-bench", "gpt-4o"
+    encoder = ChunkEncoder(request_id, model)
+    contents = (SAMPLES * (n // len(SAMPLES) + 1))[:n]
+
+    def run_legacy():
+        for content in contents:
+            legacy_chunk(request_id, model, content)
+
+    def run_encoder():
+        encode = encoder.encode
+        for content in contents:
+            encode(content)
+
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=5)) / n
+    fast = min(timeit.repeat(run_encoder, number=1, repeat=5)) / n
+    print(f"单块编码  旧实现: {legacy * 1e6:7.2f} µs   ChunkEncoder: {fast * 1e6:7.2f} µs   ({legacy / fast:.1f}x)")
+
+
+class _FakeResponse:
+    async def aclose(self):
+        pass
+
+
+async def _replay(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def bench_relay(n):
+    from app.providers.zai_provider import UpstreamStream, ZaiProvider
+    from app.utils.sse_parser import SSEDecoder
+
+    provider = ZaiProvider()
+    body = "".join(f"data: {json.dumps({'content': SAMPLES[i % len(SAMPLES)]})}\n\n" for i in range(n)) + "data: [DONE]\n\n"
+    body = body.encode("utf-8")
+    chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)]  # 模拟 aiter_bytes() 的读缓冲
+
+    async def drain():
+        upstream = UpstreamStream(_FakeResponse(), _replay(chunks), SSEDecoder(), [], "gpt-4o", "chat", "msg")
+        total = 0
+        async for chunk in provider.relay(upstream):
+            total += len(chunk)
+        return total
+
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        asyncio.run(drain())
+        best = min(best, time.perf_counter() - start)
+    print(f"relay 热路径（解析 + 编码）: {best / n * 1e6:7.2f} µs/块")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    print(f"JSON 后端: {'orjson' if sse_utils.orjson is not None else 'json'}，块数: {count}")
+    bench_encode(count)
+    logger.remove()  # 关闭 relay 结束时的 success 日志
+    bench_relay(count)
@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
+import inspect
 import time
 import os
 import secrets
 import base64
+import uuid
 from datetime import timedelta, datetime
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Depends, Header, HTTPException, Form
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from loguru import logger
 from app.core.config import settings
+from app.core.conversation_store import conversation_store
 from app.core.db_manager import db_manager
-from app.providers.zai_provider import ZaiProvider
+from app.core.image_cache import image_cache
+from app.core.log_writer import log_writer
+from app.core.metrics import StreamStats, metrics
+from app.core.response_cache import response_cache
+from app.core.single_flight import single_flight
+from app.providers.zai_provider import MODEL_DISPLAY_NAMES, ZaiProvider
+from app.utils.account_health import AccountHealthProber
+from app.utils.account_pool import ACQUIRED_PROBE, FAILURE_AUTH, account_pool
+from app.utils.admission import AdmissionRejected, admission_controller
+from app.utils.chat_pool import ChatPool
 from app.utils.har_parser import extract_token_from_text
+from app.utils.sse_utils import ChunkEncoder, create_chat_completion, estimate_prompt_tokens, estimate_tokens
 from app.utils.token_auto_refresh_service import auto_refresh_service
 
 # 图片管理类
@@ -91,28 +104,39 @@ image_manager = ImageManager()
 
 # --- 全局 Provider ---
 provider = ZaiProvider()
+health_prober = AccountHealthProber(provider)
+chat_pool = ChatPool(provider)
+# Token 被替换或账号删除后关闭对应的上游连接池
+db_manager.add_listener(lambda: provider.release_stale_clients(acc.get("token") for acc in db_manager.get_all_accounts()))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info(f"🚀 {settings.APP_NAME} v{settings.APP_VERSION} 启动中...")
     
-    # 1. 启动时检查过期 Token
-    asyncio.create_task(perform_breakpoint_update())
-    
-    # 2. 启动自动刷新服务
+    # 1. 启动自动刷新服务（按 Token 过期时间调度，启动时已过期的账号会立即刷新）
     asyncio.create_task(auto_refresh_service.start())
     
-    # 3. 启动图片管理清理任务
+    # 2. 启动账号健康探测与预创建对话池
+    asyncio.create_task(health_prober.start())
+    asyncio.create_task(chat_pool.start())
+    
+    # 3. 启动图片管理清理任务，载入图片代理缓存
     image_manager.start_cleanup_task()
+    await image_cache.start()
+    
+    # 4. 启动请求日志批量写入器，并清理过期的会话索引与响应缓存
+    log_writer.start()
+    asyncio.create_task(conversation_store.prune())
+    asyncio.create_task(response_cache.prune())
     
-    # 4. 确保必要的目录存在
+    # 5. 确保必要的目录存在
     import os
     from pathlib import Path
     dirs = ["data", "media", "static", "templates", "accounts_data", "zai_user_data"]
     for dir_name in dirs:
         Path(dir_name).mkdir(exist_ok=True, parents=True)
     
-    # 5. 显示启动信息
+    # 6. 显示启动信息
     if settings.HF_SPACE:
         logger.info(f"🌐 Hugging Face Space 服务地址: https://huggingface.co/spaces/{settings.HF_SPACE_ID}")
     else:
@@ -120,8 +144,15 @@ async def lifespan(app: FastAPI):
     
     yield
     
-    # 6. 停止服务
+    # 7. 停止服务
     auto_refresh_service.stop()
+    await auto_refresh_service.close()
+    health_prober.stop()
+    chat_pool.stop()
+    await log_writer.stop()
+    await provider.close()
+    await image_cache.close()
+    db_manager.close()
     logger.info("🛑 服务已停止")
 
 app = FastAPI(lifespan=lifespan, title=settings.APP_NAME)
@@ -133,7 +164,7 @@ import secrets
 from datetime import timedelta
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, RedirectResponse
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse, RedirectResponse
 import httpx
 import urllib.parse
 
@@ -149,9 +180,10 @@ app.mount("/media", StaticFiles(directory=media_dir), name="media")
 
 # 图片代理端点 - 处理 Zai 图片的跨域问题
 @app.get("/img-proxy")
-async def img_proxy(url: str):
+async def img_proxy(request: Request, url: str):
     """
     图片代理端点，用于处理 Zai 图片的跨域问题
+    共用连接池流式转发，并缓存到 media/proxy/（支持 ETag / If-None-Match 与 Range）
     """
     try:
         # 验证URL是否为Zai的图片URL
@@ -164,27 +196,8 @@ async def img_proxy(url: str):
                 # 如果不是URL格式，返回错误
                 return JSONResponse({"error": "无效的图片URL"}, status_code=400)
         
-        # 下载图片
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=30)
-            response.raise_for_status()
-            
-            # 获取内容类型
-            content_type = response.headers.get('content-type', 'image/jpeg')
-            
-            # 返回图片
-            from fastapi.responses import Response
-            return Response(
-                content=response.content,
-                media_type=content_type,
-                headers={
-                    "Cache-Control": "public, max-age=3600",  # 缓存1小时
-                    "Access-Control-Allow-Origin": "*",      # 允许跨域访问
-                    "Access-Control-Allow-Methods": "GET, OPTIONS",   # 允许GET和OPTIONS方法
-                    "Access-Control-Allow-Headers": "*",      # 允许所有头部
-                    "Access-Control-Allow-Credentials": "false"  # 不包含凭据
-                }
-            )
+        # 命中缓存直接返回文件；否则下载（同一 URL 只下载一次）并边下载边转发
+        return await image_cache.serve(request, url)
     except httpx.HTTPStatusError as e:
         logger.error(f"图片代理错误 - HTTP状态码: {e.response.status_code}")
         # 返回一个默认图片或错误
@@ -203,8 +216,8 @@ async def verify_api_key(authorization: str = Header(None)):
 # --- 页面路由 ---
 @app.get("/", response_class=HTMLResponse)
 async def dashboard(request: Request):
-    accounts = db_manager.get_all_accounts()
-    logs = db_manager.get_recent_logs()
+    accounts = await db_manager.aget_all_accounts()
+    logs = await db_manager.aget_recent_logs()
     
     active_count = len([acc for acc in accounts if acc["is_active"]])
     inactive_count = len(accounts) - active_count
@@ -235,7 +248,7 @@ async def start_browser_login(name: str = Form(...)):
     logger.info(f"🌐 Web UI 请求启动浏览器登录: {name}")
     
     # 检查重名
-    accounts = db_manager.get_all_accounts()
+    accounts = await db_manager.aget_all_accounts()
     for acc in accounts:
         if acc['name'] == name:
             return JSONResponse(status_code=400, content={"success": False, "message": "账号名称已存在"})
@@ -250,10 +263,10 @@ async def start_browser_login(name: str = Form(...)):
 @app.post("/api/account/add")
 async def add_account(name: str = Form(...), token: str = Form(...)):
     """手动添加 Token"""
-    if not provider.verify_token(token):
+    if not await provider.averify_token(token):
         return JSONResponse(status_code=400, content={"success": False, "message": "Token 无效"})
     
-    account_id = db_manager.create_account(name, token, None, 'manual')
+    account_id = await db_manager.acreate_account(name, token, None, 'manual')
     if account_id:
         return JSONResponse({"success": True, "message": "账号添加成功"})
     return JSONResponse(status_code=500, content={"success": False, "message": "数据库错误"})
@@ -263,22 +276,49 @@ async def extract_token_api(request: Request):
     data = await request.json()
     token = extract_token_from_text(data.get("content", ""))
     if token:
-        return JSONResponse({"success": True, "token": token, "is_valid": provider.verify_token(token)})
+        return JSONResponse({"success": True, "token": token, "is_valid": await provider.averify_token(token)})
     return JSONResponse({"success": False, "message": "未找到 Token"})
 
 @app.get("/api/account/delete/{id}")
 async def delete_account(id: int):
-    db_manager.delete_account(id)
+    await db_manager.adelete_account(id)
     return RedirectResponse("/", status_code=303)
 
 @app.get("/api/account/toggle/{id}")
 async def toggle_account(id: int):
-    db_manager.toggle_account(id)
+    await db_manager.atoggle_account(id)
     return RedirectResponse("/", status_code=303)
 
+@app.get("/api/logs/stats")
+async def log_stats():
+    """日志写入器计数（排队、已写入、丢弃）"""
+    return JSONResponse(log_writer.stats())
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 文本格式的运行指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def _collect_runtime_metrics():
+    """抓取时更新状态类指标：账号池各状态数量及后台组件计数"""
+    states = account_pool.state_counts()
+    states["disabled"] = len(db_manager.get_all_accounts()) - len(db_manager.get_all_accounts(active_only=True))
+    metrics.accounts.replace({(state,): count for state, count in states.items()})
+    samples = {("log_writer", stat): value for stat, value in log_writer.stats().items()}
+    if chat_pool is not None:
+        samples.update({("chat_pool", stat): value for stat, value in chat_pool.stats().items()})
+    samples.update({("admission", stat): value for stat, value in admission_controller.stats().items()})
+    samples.update({("response_cache", stat): value for stat, value in response_cache.stats().items()})
+    samples.update({("single_flight", stat): value for stat, value in single_flight.stats().items()})
+    samples.update({("image_cache", stat): value for stat, value in image_cache.stats().items()})
+    metrics.component.replace(samples)
+
+metrics.add_collector(_collect_runtime_metrics)
+metrics.known_models = frozenset(MODEL_DISPLAY_NAMES)  # 与 /v1/models 列表一致
+
 @app.get("/api/logs/clear")
 async def clear_logs():
-    db_manager.clear_logs()
+    await db_manager.aclear_logs()
     return RedirectResponse("/", status_code=303)
 
 # --- API 路由 (OpenAI 兼容) ---
@@ -291,27 +331,408 @@ async def chat_completions(request: Request):
         raise HTTPException(status_code=400, detail="Invalid JSON")
         
     model = request_data.get("model", settings.DEFAULT_MODEL)
-    accounts = db_manager.get_all_accounts(active_only=True)
+    
+    # 响应缓存：相同的确定性请求直接回放，不占用准入名额和账号
+    cache_key = response_cache.cache_key(request, request_data)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return _replay_cached(request_data, model, start_time, cached)
+    
+    # 单飞：相同的请求正在处理时订阅它的输出，不再单独请求上游
+    flight = None
+    flight_key = single_flight.flight_key(request, request_data, model)
+    if flight_key is not None:
+        flight, leader = single_flight.join(flight_key, model)
+        if not leader:
+            response = await _follow_flight(request_data, model, start_time, flight)
+            if response is not None:
+                return response
+            flight = None  # 领头请求在产出内容之前失败，自行处理
+    
+    ticket = None
+    try:
+        # 准入控制：超出账号池容量时排队，预计等不到时立即 429
+        if settings.ADMISSION_ENABLED:
+            api_key = _bearer_token(request)
+            lane = admission_controller.lane_for(request.headers.get("x-priority"), api_key)
+            tenant = api_key or (request.client.host if request.client else "")
+            try:
+                ticket = await admission_controller.acquire(lane, tenant)
+            except AdmissionRejected as e:
+                metrics.count_request(model, "throttled")
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"服务繁忙: {e}",
+                    headers={"Retry-After": admission_controller.retry_after_header(e.retry_after)},
+                )
+        
+        response = await _serve_completion(request, request_data, model, start_time, ticket, cache_key, flight)
+    except BaseException as e:
+        admission_controller.release(ticket)
+        single_flight.finish(flight, e)
+        raise
+    if not isinstance(response, StreamingResponse):
+        # 流式响应在流结束时交还名额、结束单飞
+        admission_controller.release(ticket)
+        single_flight.finish(flight, None if response.status_code == 200 else ConnectionAbortedError("客户端已断开"))
+    return response
+
+def _bearer_token(request: Request):
+    authorization = request.headers.get("authorization") or ""
+    scheme, _, token = authorization.partition(" ")
+    return token.strip() if scheme.lower() == "bearer" and token.strip() else None
+
+def _replay_cached(request_data: dict, model: str, start_time: float, cached):
+    """用缓存的回复构造响应，stream 与否与原始请求无关"""
+    metrics.count_request(model, "cached")
+    log_writer.submit("cache", model, "CACHED", int((time.time() - start_time) * 1000),
+                     bytes_sent=cached.size, chunks=len(cached.parts))
+    request_id = f"chatcmpl-{uuid.uuid4()}"
+    headers = {"X-Cache": "HIT"}
+    if request_data.get("stream", True) is False:
+        return JSONResponse(_completion_body(request_id, model, request_data, cached.content), headers=headers)
+    return StreamingResponse(
+        response_cache.replay(cached, ChunkEncoder(request_id, model)), media_type="text/event-stream", headers=headers
+    )
+
+async def _follow_flight(request_data: dict, model: str, start_time: float, flight):
+    """订阅正在进行的相同请求；领头请求在产出内容之前失败时返回 None"""
+    subscription = flight.subscribe()
+    request_id = f"chatcmpl-{uuid.uuid4()}"
+    headers = {"X-Single-Flight": "SHARED"}
+    if request_data.get("stream", True) is False:
+        try:
+            started = await asyncio.wait_for(subscription.wait_started(), timeout=settings.SINGLE_FLIGHT_WAIT_TIMEOUT)
+            parts = await subscription.read_all() if started else None
+        except asyncio.TimeoutError:
+            logger.warning(f"⏳ 单飞等待首个内容超时 ({settings.SINGLE_FLIGHT_WAIT_TIMEOUT:.0f}s)，自行请求上游")
+            parts = None
+        except Exception:
+            parts = None
+        if parts is None:
+            subscription.close()
+            return None  # 尚未向客户端发送任何内容，可以自行重试
+        response = JSONResponse(_completion_body(request_id, model, request_data, "".join(parts)), headers=headers)
+    else:
+        try:
+            started = await asyncio.wait_for(subscription.wait_started(), timeout=settings.SINGLE_FLIGHT_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            subscription.close()
+            logger.warning(f"⏳ 单飞等待首个内容超时 ({settings.SINGLE_FLIGHT_WAIT_TIMEOUT:.0f}s)，自行请求上游")
+            return None
+        except BaseException:
+            subscription.close()
+            raise
+        if not started:
+            subscription.close()
+            return None
+        response = _GuardedStreamingResponse(
+            subscription.stream(ChunkEncoder(request_id, model)), subscription.close,
+            media_type="text/event-stream", headers=headers,
+        )
+    metrics.count_request(model, "shared")
+    log_writer.submit("single-flight", model, "SHARED", int((time.time() - start_time) * 1000))
+    return response
+
+def _completion_body(request_id: str, model: str, request_data: dict, content: str) -> dict:
+    return create_chat_completion(
+        request_id, model, content,
+        prompt_tokens=estimate_prompt_tokens(request_data.get("messages", [])),
+        completion_tokens=estimate_tokens(content),
+    )
+
+async def _serve_completion(request: Request, request_data: dict, model: str, start_time: float, ticket,
+                            cache_key=None, flight=None):
+    """选择账号、打开上游并返回响应（故障转移在此进行）"""
+    messages = request_data.get("messages") or []
+    accounts = account_pool.candidates()
     
     if not accounts:
+        if len(account_pool):
+            # 有账号但全部达到并发上限或处于限流冷却中
+            metrics.count_request(model, "throttled")
+            raise HTTPException(
+                status_code=429,
+                detail="所有账号繁忙或被限流，请稍后重试",
+                headers={"Retry-After": str(max(int(account_pool.retry_after() + 0.999), 1))},
+            )
         raise HTTPException(status_code=503, detail="没有可用账号")
     
+    # 会话复用：命中则优先使用该对话所属账号，只发送新增消息
+    conversation = None
+    hasher = None
+    if settings.CONVERSATION_REUSE and messages:
+        prefix_hashes = conversation_store.prefix_hashes(model, messages)
+        hasher = conversation_store.assistant_hasher(prefix_hashes[-1])
+        conversation = await conversation_store.lookup(messages, prefix_hashes)
+        if conversation is not None:
+            owner = [acc for acc in accounts if acc["id"] == conversation.entry.account_id]
+            if owner:
+                accounts = owner + [acc for acc in accounts if acc["id"] != conversation.entry.account_id]
+            else:
+                conversation = None
+    
+    deadline = time.time() + settings.FAILOVER_DEADLINE  # 从获准时开始计算，不含排队时间
+    last_error = None
     for account in accounts:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            last_error = "故障转移超时"
+            break
+        
+        acquired = account_pool.acquire(account["id"])
+        if not acquired:
+            continue  # 选择之后已达并发上限或进入冷却
+        probe = acquired == ACQUIRED_PROBE  # 熔断半开时的探测请求
         try:
-            # 直接使用 Token 请求
-            response_generator = provider.chat_completion(request_data, account["token"])
-            
-            # 记录日志
-            duration = int((time.time() - start_time) * 1000)
-            db_manager.add_log(account["name"], model, "SUCCESS", duration)
-            
-            return StreamingResponse(response_generator, media_type="text/event-stream")
+            # 驱动上游完成创建对话并收到首个事件，之后才向客户端提交响应
+            continuation = conversation if conversation is not None and account["id"] == conversation.entry.account_id else None
+            ready_chat_id = chat_pool.take(account, model) if continuation is None else None
+            upstream = await asyncio.wait_for(
+                provider.open_stream(request_data, account["token"], continuation, ready_chat_id), timeout=remaining
+            )
+        except ValueError as e:
+            account_pool.release(account["id"], success=None, probe=probe)  # 请求本身无效，与账号无关
+            metrics.count_request(model, "bad_request")
+            raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
-            logger.error(f"账号 {account['name']} 失败: {e}")
-            db_manager.add_log(account["name"], model, "ERROR", int((time.time() - start_time) * 1000))
+            account_pool.release(account["id"], success=False, probe=probe)
+            metrics.upstream_errors.inc(str(getattr(e, "status_code", None) or type(e).__name__))
+            _report_account_failure(account, e)
+            last_error = str(e) or type(e).__name__
+            logger.error(f"账号 {account['name']} 失败: {last_error}")
+            log_writer.submit(account["name"], model, "ERROR", int((time.time() - start_time) * 1000), message=last_error[:500])
             continue
+        
+        stats = StreamStats()
+        # 单飞时内容片段写入 Flight 分发给订阅者（响应缓存也从中读取）
+        captured = flight if flight is not None else ([] if cache_key is not None else None)
+        if request_data.get("stream", True) is False:
+            # 非流式：读完上游后返回单个 chat.completion JSON
+            metrics.inflight_streams.inc()
+            watcher = _DisconnectWatcher(request, upstream)
+            try:
+                body = await watcher.read(provider.collect(upstream, request_data, hasher, stats, captured))
+            except Exception as e:
+                cancelled = watcher.disconnected
+                status = "CANCELLED" if cancelled else "ERROR"
+                account_pool.release(account["id"], success=None if cancelled else False, probe=probe)
+                if not cancelled:
+                    _report_account_failure(account, e)
+                metrics.count_request(model, status.lower())
+                _submit_request_log(account, model, start_time, status, upstream, stats, None if cancelled else str(e))
+                if cancelled:
+                    logger.info(f"🔌 客户端已断开，取消账号 {account['name']} 的上游请求")
+                    return JSONResponse(status_code=499, content={"detail": "客户端已断开"})
+                logger.error(f"账号 {account['name']} 读取响应失败: {e}")
+                raise HTTPException(status_code=502, detail=f"上游响应中断: {e}")
+            finally:
+                watcher.stop()
+                metrics.inflight_streams.dec()
+            account_pool.release(account["id"], success=True, probe=probe)
+            metrics.count_request(model, "success")
+            metrics.observe_stream(model, account["name"], start_time, stats)
+            response = JSONResponse(body)
+            stats.bytes = len(response.body)
+            _submit_request_log(account, model, start_time, "SUCCESS", upstream, stats)
+            if hasher is not None:
+                await conversation_store.remember(hasher.hexdigest(), upstream.chat_id, upstream.message_id, account["id"], model)
+            if cache_key is not None:
+                await response_cache.put(cache_key, model, captured)
+            return response
+        
+        async def on_success(upstream=upstream, account=account):
+            if hasher is not None:
+                await conversation_store.remember(
+                    hasher.hexdigest(), upstream.chat_id, upstream.message_id, account["id"], model
+                )
+            if cache_key is not None and stats.finished_at:  # relay 只在完整结束时记录 finished_at
+                await response_cache.put(cache_key, model, captured)
+        
+        generator = provider.relay(upstream, hasher, stats, captured)
+        if flight is not None:
+            # 上游由后台任务读取，领头请求与其他订阅者一样从自己的缓冲读取
+            generator = flight.start(generator).stream(ChunkEncoder(f"chatcmpl-{uuid.uuid4()}", model))
+        finisher = _StreamFinisher(account, model, start_time, upstream, stats, ticket, flight, probe)
+        return _GuardedStreamingResponse(
+            _track_account(request, finisher, generator, on_success),
+            lambda: finisher.finish("CANCELLED"),
+            media_type="text/event-stream",
+        )
             
-    raise HTTPException(status_code=503, detail="所有账号均调用失败")
+    metrics.count_request(model, "error")
+    raise HTTPException(status_code=503, detail=f"所有账号均调用失败: {last_error or '账号繁忙'}")
+
+def _submit_request_log(account, model: str, start_time: float, status: str, upstream, stats: StreamStats, message=None):
+    """请求结束时写入一条带阶段耗时的日志"""
+    now = time.time()
+    log_writer.submit(
+        account["name"], model, status,
+        duration=int((now - start_time) * 1000),
+        chat_ms=upstream.chat_ms,
+        ttfb_ms=upstream.ttfb_ms,
+        stream_ms=int(((stats.finished_at or now) - upstream.opened_at) * 1000),
+        bytes_sent=stats.bytes,
+        chunks=stats.chunks,
+        message=message[:500] if message else None,
+    )
+
+def _report_account_failure(account, error):
+    """更新账号熔断/冷却状态；认证失败（401）时刷新浏览器账号的 Token，手动账号直接禁用"""
+    kind = account_pool.report_failure(account["id"], error)
+    if kind == FAILURE_AUTH:
+        asyncio.create_task(_recover_account(account))
+
+async def _recover_account(account):
+    try:
+        if account.get("token_source") == "browser" and account.get("data_dir"):
+            logger.info(f"🔄 账号 {account['name']} 认证失败，排队刷新 Token")
+            await auto_refresh_service.refresh_token_now(account["id"])
+        else:
+            logger.warning(f"🚫 手动账号 {account['name']} 认证失败，已禁用")
+            await db_manager.adisable_account(account["id"])
+    except Exception as e:
+        logger.error(f"恢复账号 {account['name']} 失败: {e}")
+
+class _DisconnectWatcher:
+    """
+    客户端断开检测：定期检查 Request，断开后关闭上游连接，
+    并中断正在等待上游数据的读取（长时间思考的模型可能几分钟都没有输出）
+    upstream 为 None 时只中断读取（单飞的领头请求：上游由 Flight 在最后一个订阅者离开时关闭）
+    """
+
+    def __init__(self, request: Request, upstream):
+        self.request = request
+        self.upstream = upstream
+        self.disconnected = False
+        self._reader = None  # 正在 read() 中等待的任务
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while not await self.request.is_disconnected():
+                await asyncio.sleep(settings.DISCONNECT_CHECK_INTERVAL)
+        except Exception as e:
+            logger.debug(f"断开检测结束: {e}")
+            return
+        self.disconnected = True
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.upstream is not None:
+            await self.upstream.aclose()
+
+    async def read(self, awaitable):
+        """等待上游数据；客户端断开时抛出 ConnectionAbortedError"""
+        self._reader = asyncio.current_task()
+        try:
+            return await awaitable
+        except asyncio.CancelledError:
+            if not self.disconnected:
+                raise
+            uncancel = getattr(self._reader, "uncancel", None)  # Python 3.11+
+            if uncancel is not None:
+                uncancel()
+            raise ConnectionAbortedError("客户端已断开")
+        finally:
+            self._reader = None
+
+    def stop(self):
+        self._task.cancel()
+
+class _StreamFinisher:
+    """
+    流式请求的收尾：释放账号池占用与准入名额、结束单飞、记录指标并写入日志，只执行一次
+    正常由 _track_account 在流结束时调用；响应体从未开始迭代时由 _GuardedStreamingResponse 兜底调用
+    单飞的领头请求断开时，若还有其他订阅者，上游继续读取，账号在单飞结束时才释放
+    """
+
+    def __init__(self, account, model: str, start_time: float, upstream, stats: StreamStats,
+                 ticket=None, flight=None, probe=False):
+        self.account = account
+        self.model = model
+        self.start_time = start_time
+        self.upstream = upstream
+        self.stats = stats
+        self.ticket = ticket
+        self.flight = flight
+        self.probe = probe
+        self.finished = False
+
+    async def finish(self, status: str, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        account, probe = self.account, self.probe
+        message = (str(error) or type(error).__name__) if error is not None else None
+        admission_controller.release(self.ticket)
+        if status == "ERROR":
+            account_pool.release(account["id"], success=False, probe=probe)
+            _report_account_failure(account, error)
+        handed_off = status == "CANCELLED" and single_flight.hand_off(
+            self.flight, lambda e: account_pool.release(account["id"], success=True if e is None else None, probe=probe)
+        )
+        if status != "SUCCESS" and not handed_off:
+            single_flight.finish(self.flight, ConnectionAbortedError(message or "客户端已断开"))
+            await self.upstream.aclose()  # 被框架取消时生成器不一定立即关闭，这里主动断开上游
+        if status != "ERROR" and not handed_off:
+            # 客户端取消不算账号失败，也不能作为账号健康的证据
+            account_pool.release(account["id"], success=True if status == "SUCCESS" else None, probe=probe)
+        metrics.count_request(self.model, status.lower())
+        if status == "SUCCESS":
+            metrics.observe_stream(self.model, account["name"], self.start_time, self.stats)
+        _submit_request_log(account, self.model, self.start_time, status, self.upstream, self.stats, message)
+
+class _GuardedStreamingResponse(StreamingResponse):
+    """
+    客户端在响应开始前断开时，框架可能根本不迭代响应体，生成器的 finally 不会执行；
+    响应结束后关闭生成器并调用 on_close（须可重复调用，可返回协程）兜底清理
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self._content = content
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._content.aclose()
+            result = self._on_close()
+            if inspect.isawaitable(result):
+                await result
+
+async def _track_account(request: Request, finisher: _StreamFinisher, generator, on_success=None):
+    """
+    包装响应流，流结束时交给 finisher 收尾；客户端中途断开时关闭上游并记为 CANCELLED
+    只有完整结束时才执行 on_success 回调（返回协程）
+    """
+    status, error = "CANCELLED", None
+    metrics.inflight_streams.inc()
+    watcher = _DisconnectWatcher(request, finisher.upstream if finisher.flight is None else None)
+    try:
+        while True:
+            try:
+                chunk = await watcher.read(generator.__anext__())
+            except StopAsyncIteration:
+                break
+            yield chunk
+        status = "SUCCESS"
+    except Exception as e:
+        if not watcher.disconnected:
+            status, error = "ERROR", e
+            logger.error(f"账号 {finisher.account['name']} 响应流中断: {str(e) or type(e).__name__}")
+            raise
+        logger.info(f"🔌 客户端已断开，取消账号 {finisher.account['name']} 的上游请求")
+    finally:
+        watcher.stop()
+        metrics.inflight_streams.dec()
+        await finisher.finish(status, error)
+    if status != "SUCCESS":
+        return  # 客户端中途断开：回复不完整，不能用于会话索引或缓存
+    if on_success is not None:
+        await on_success()
 
 @app.get("/v1/models")
 
@@ -376,8 +797,7 @@ async def set_preview_mode(request: Request):
 @app.post("/api/refresh/force")
 async def force_refresh_all():
     """强制刷新所有浏览器账号"""
-    accounts = db_manager.get_all_accounts(active_only=True)
-    browser_accounts = [acc for acc in accounts if acc['token_source'] == 'browser']
+    browser_accounts = db_manager.get_accounts_by_source('browser')
     
     if not browser_accounts:
         return JSONResponse(status_code=400, content={
@@ -385,28 +805,36 @@ async def force_refresh_all():
             "message": "没有浏览器来源的账号"
         })
     
-    # 异步刷新所有账号
+    # 异步刷新所有账号（由刷新服务限制同时运行的浏览器数量）
     for account in browser_accounts:
         asyncio.create_task(auto_refresh_service.refresh_token_now(account['id']))
     
     return JSONResponse({
         "success": True,
-        "message": f"已启动刷新任务，将依次刷新 {len(browser_accounts)} 个账号"
+        "message": f"已启动刷新任务，将分批刷新 {len(browser_accounts)} 个账号（每批最多 {settings.REFRESH_CONCURRENCY} 个）"
     })
 
 @app.get("/api/account/status")
-async def get_account_status():
-    """获取所有账号的Token有效性状态"""
-    accounts = db_manager.get_all_accounts()
+async def get_account_status(force: bool = False):
+    """
+    获取所有账号的Token有效性状态
+    默认直接返回后台探测快照；force=true 时先并发重新探测所有账号
+    """
+    if force:
+        await health_prober.check_all()
+    
+    accounts = await db_manager.aget_all_accounts()
     status_list = []
     
     for account in accounts:
-        is_valid = provider.verify_token(account['token']) if account.get('token') else False
+        health = health_prober.get(account)
         status_list.append({
             "id": account['id'],
             "name": account['name'],
             "is_active": account['is_active'],
-            "is_valid": is_valid,
+            "is_valid": health.is_valid if health else (False if not account.get('token') else None),
+            "checked_at": health.checked_at if health else None,
+            "latency_ms": health.latency_ms if health else None,
             "total_calls": account['total_calls'],
             "token_source": account['token_source'],
             "expires_at": account.get('expires_at'),
@@ -433,35 +861,6 @@ async def stop_service():
         "message": "服务将在3秒后停止..."
     })
 
-async def perform_breakpoint_update():
-    """启动时检查过期 Token"""
-    from datetime import datetime
-    try:
-        accounts = db_manager.get_all_accounts(active_only=True)
-        browser_accounts = [acc for acc in accounts if acc['token_source'] == 'browser']
-        
-        if not browser_accounts:
-            logger.info("ℹ️ 没有浏览器账号需要检查")
-            return
-        
-        logger.info(f"📊 检查 {len(browser_accounts)} 个浏览器账号...")
-        
-        for acc in browser_accounts:
-            if acc.get('expires_at'):
-                try:
-                    exp = datetime.fromisoformat(acc['expires_at'])
-                    remaining = (exp - datetime.now()).total_seconds()
-                    
-                    if remaining < 3600:
-                        logger.warning(f"⚠️ 账号 [{acc['name']}] 即将过期（{int(remaining/60)}分钟后），开始刷新...")
-                        await auto_refresh_service.refresh_token_now(acc['id'])
-                    else:
-                        logger.info(f"✅ 账号 [{acc['name']}] Token有效（{int(remaining/3600)}小时后过期）")
-                except Exception as e:
-                    logger.error(f"检查账号 [{acc['name']}] 失败: {e}")
-    except Exception as e:
-        logger.error(f"断点更新失败: {e}")
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=settings.PORT)